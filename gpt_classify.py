@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
+import asyncio
 import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-import openai
-from openai.error import RateLimitError, ServiceUnavailableError, APIError
+from openai import AsyncOpenAI
 
 import gpt_common as gpt
 import impacts_common as impacts
@@ -14,11 +15,19 @@ import impacts_common as impacts
 # secret key, which enables the use of the ChatGPT API
 KEY_FILE = './secrets/key.json'
 
-# Timeout wait time
-# FREE API KEY = 20s wait times
-# PAID API KEY = 1s wait times
-WAIT_TIME = 20
-#WAIT_TIME = 1
+# Maximum number of API requests that can be in flight at the same time, while
+# classifying a batch of LSRs
+MAX_IN_FLIGHT = 10
+
+# Number of LSR remarks which will be sent to the API in each single request
+REMARKS_PER_REQUEST = 5
+
+# API request rate limits, in Requests Per Minute (RPM) and Tokens Per Minute
+# (TPM), which can be overridden through the environment
+# FREE API KEY = 3 RPM / 150,000 TPM
+# PAID API KEY = 60 RPM / 250,000 TPM
+RPM_LIMIT = int(os.environ.get("OPENAI_RPM_LIMIT", 3))
+TPM_LIMIT = int(os.environ.get("OPENAI_TPM_LIMIT", 150000))
 
 
 # Constant which will hold the path to a text file contatining a narrative for
@@ -40,21 +49,81 @@ MAX_BATCHES = 0
 # Constant which will hold the path to the desires results output location
 RESULTS_OUTPUT = './results/'
 
+# Constant which will hold the path to the SQLite database file used to cache
+# GPT API results, so repeated remarks are not sent to the API again (the same
+# file used by default by gpt.ResponseCache())
+CACHE_FILE = gpt.DEFAULT_CACHE_FILE
+
 
 # Main function, which will be the entry point that will be executed, when this
 # program is run as a script from the command line
-def main():
+def main(reconcile=False):
     '''Main function and point of entry for the execution of this script.
-    '''
-    # Import the secret OpenAI API key from the JSON file
-    openai.api_key = gpt.read_api_key(KEY_FILE)
 
+    Creates the API client, the event loop runner, the rate limiter, the
+    cache of GPT API results, and the background writer thread shared by all
+    the batches, and classifies the LSR file with classify_lsr_file(). These
+    are always shut down afterwards, even if the classification fails.
+    '''
+    # Create a single OpenAI API client, using the secret OpenAI API key from
+    # the JSON file, which will be reused by all the API requests. Failed
+    # requests are retried by gpt.with_backoff(), instead of by the client
+    client = AsyncOpenAI(api_key=gpt.read_api_key(KEY_FILE), max_retries=0)
+
+    # Create a single event loop runner, so that all the batches are
+    # classified on the same event loop, which the client's connections are
+    # bound to
+    runner = asyncio.Runner()
+
+    # Create a single rate limiter, shared by all the API requests
+    limiter = gpt.RateLimiter(rpm_capacity=RPM_LIMIT, tpm_capacity=TPM_LIMIT)
+
+    # Open the cache of previous GPT API results
+    cache = gpt.ResponseCache(CACHE_FILE)
+
+    # Background writer thread, which writes out the results of each batch
+    # while the next batch is being classified
+    writer = ThreadPoolExecutor(max_workers=1)
+
+    # Classify the LSR file, making sure everything is shut down even if it
+    # fails (when the API requests keep failing after every retry)
+    try:
+        classify_lsr_file(client, runner, limiter, cache, writer,
+                          reconcile=reconcile)
+
+    # Wait for any pending writes to finish, and close the cache of GPT API
+    # results, the API client, and the event loop
+    finally:
+        writer.shutdown(wait=True)
+        cache.close()
+        runner.run(client.close())
+        runner.close()
+
+
+def classify_lsr_file(client, runner, limiter, cache, writer,
+                      reconcile=False):
+    '''Classify the LSR file, one batch at a time, writing out the results.
+
+    Batches already processed by previous runs are read from the progress
+    file of the LSR file being processed. If reconcile is True, or if there is
+    no progress file yet, they are found by scanning the results output
+    folder for batch result JSON files instead. The classified LSRs CSV file
+    is rebuilt from the batch result files whenever it may not match the
+    processed batches, and the processed batches whose batch result file is
+    then found missing are processed again. The results of each batch are
+    written out by the writer thread, while the next batch is classified.
+    '''
     # Read FFSI definition
     impact_defs = impacts.read_textual_definition(FFSI_DEFINITIONS)
 
-    # Read whole LSRs from a standard CSV file
-    #lsr_reports = impacts.read_standard_lsrs(LSR_FILE)
-    lsr_reports = impacts.read_ibw_lsrs(LSR_FILE)
+    # Read whole LSRs from a standard CSV file, which includes a category
+    # column, like the default LSR_FILE (use impacts.read_ibw_lsrs() instead
+    # for Expertly-Classified LSR files)
+    lsr_reports = impacts.read_standard_lsrs(LSR_FILE, no_category=False)
+
+    # Extract the LSR remarks once, as an array which can be sliced for each
+    # batch without copying
+    remarks = lsr_reports['remark'].to_numpy(dtype=object)
 
     # Define a Unique Identifyer for the LSR file that is being processed
     lsr_uuid = impacts.hash_filename(LSR_FILE)
@@ -63,11 +132,97 @@ def main():
     # restart the process, in case of interruptions or failure.
     batches = impacts.define_batches(lsr_reports.shape[0], BATCH_SIZE)
 
-    # Check for pre-existing batch result JSON files, and if found, update the
-    # batches dictionary with "processed": True, for the matching batches
-    batches = impacts.match_batch_results(file_uuid=lsr_uuid,
-                                          batches=batches,
-                                          results_path=RESULTS_OUTPUT)
+    # Path of the progress file, holding the IDs of the batches that have been
+    # processed for the current LSR file, along with the size of the CSV file
+    # holding their classified LSRs, to which the results of each batch are
+    # appended as soon as the batch is processed
+    progress_path = os.path.join(RESULTS_OUTPUT, f"{lsr_uuid}.progress.json")
+    classified_path = os.path.join(RESULTS_OUTPUT,
+                                   f"{lsr_uuid}_classified.csv")
+
+    # If there is a progress file, and no reconciliation was requested, mark
+    # the batches in it as processed, trusting that their batch result JSON
+    # files are still there, so that the output folder is not scanned
+    if os.path.exists(progress_path) and not reconcile:
+        progress = impacts.read_json_results(progress_path)
+        csv_size = progress.get("csv_size")
+
+        # Ignore the IDs of batches which are not defined (e.g. if the batch
+        # size changed), in which case the CSV file is rebuilt as well
+        processed_ids = [batch_id for batch_id in progress["processed"]
+                         if 0 <= batch_id < len(batches)]
+        if len(processed_ids) < len(progress["processed"]):
+            print(f"WARNING: Ignoring "
+                  f"{len(progress['processed']) - len(processed_ids)} "
+                  f"processed batches in {progress_path}, since there are "
+                  f"only {len(batches)} batches!")
+            csv_size = None
+        batches.processed[processed_ids] = True
+
+    # Else, check for pre-existing batch result JSON files, and if found,
+    # mark the matching batches as processed
+    else:
+        batches = impacts.match_batch_results(file_uuid=lsr_uuid,
+                                              batches=batches,
+                                              results_path=RESULTS_OUTPUT)
+        csv_size = None
+
+        # If none were found, warn about batch result files left by earlier
+        # versions, whose file name UUIDs were generated differently, and
+        # are not picked up
+        if not batches.processed.any():
+            legacy_uuid = impacts.legacy_hash_filename(LSR_FILE)
+            legacy_files = impacts.find_batch_results(legacy_uuid,
+                                                      RESULTS_OUTPUT)
+            if legacy_files:
+                print(f"WARNING: Found {len(legacy_files)} batch result "
+                      f"files named after the UUID {legacy_uuid} of earlier "
+                      f"versions! Rename them after the new UUID {lsr_uuid}, "
+                      f"and run with --reconcile, to resume from them")
+
+    # Whether the classified LSRs CSV file has to be rebuilt once the pending
+    # batches are processed, instead of appending their results to it
+    rebuild_csv = False
+
+    # If no batch has been processed yet, start over with a new classified LSRs
+    # CSV file, discarding any stale one
+    if not batches.processed.any():
+        if os.path.exists(classified_path):
+            os.remove(classified_path)
+
+    # Else if the classified LSRs CSV file may not hold exactly the results of
+    # the processed batches (it is missing, was reconciled, or its size
+    # differs from the one recorded along with them, e.g. if a run was
+    # interrupted after appending to it but before updating the progress
+    # file), (re)build it from their batch result JSON files, so that it
+    # already holds the results of the batches that will be skipped, and only
+    # them
+    elif (csv_size is None or not os.path.exists(classified_path)
+          or os.path.getsize(classified_path) != csv_size):
+        # Read the JSON batch result files of the processed batches in the
+        # output path in parallel, along with their batch IDs, and process
+        # the batches whose file is missing again
+        result_files = impacts.read_batch_results(
+            lsr_uuid, RESULTS_OUTPUT, batch_ids=batches.processed_ids())
+        batches, _ = impacts.unmark_missing_results(
+            batches, [batch_id for batch_id, _ in result_files])
+
+        # If a pending batch now comes before a processed one, appending its
+        # results would leave the classified LSRs CSV file out of the order
+        # of the LSRs, so remove it, and rebuild it once every pending batch
+        # has been processed instead
+        rebuild_csv = batches.is_out_of_order()
+        if rebuild_csv:
+            if os.path.exists(classified_path):
+                os.remove(classified_path)
+        else:
+            write_classified_csv(result_files, lsr_reports, batches,
+                                 classified_path)
+
+    # Save the processed batches, which now match the CSV file, to the
+    # progress file
+    impacts.write_progress(batches.processed_ids(), progress_path,
+                           classified_path)
 
     # Process the LSRs, using the ChatGPT API to classify them
 
@@ -77,84 +232,109 @@ def main():
     print(f"Processing LSR file {lsr_uuid}: {lsr_reports.shape[0]} reports / "
           f"{num_batches} batches")
 
+    # List of the pending writes submitted to the background writer thread
+    pending_writes = []
+
     # Variables to keep track of the total number of processed reports, as well
     # as the number of processed and skipped batches
     total_processed = 0
-    batches_skipped = 0
+    batches_skipped = int(batches.processed.sum())
     batches_processed = 0
+    processed_lsrs = None
 
-    # For each batch in batches
-    for batch_id in batches:
-        # if verbose:
-        print(f"Batch ID: {batch_id}")
-        # If the current batch has been processed
-        if batches[batch_id]["processed"]:
-            # Do nothing, and move to the next batch
-            # Keep track of how many batches were skipped
-            batches_skipped += 1
-            # if verbose:
-            print(f"WARNING: Skipping batch {batch_id + 1}/{num_batches}"
-                  f"- already processed")
-            processed_lsrs = None
-
-        # If not, process the current batch
-        else:
-            # Get the current batch start and end indices for the LSR DataFrame
-            start_idx, end_idx = batches[batch_id]["indices"]
-
-            # if verbose:
-            print(f"Indices: ({start_idx},{end_idx})")
-
-            # Subset the LSR reports to only select the reports for this batch.
-            # Notice that the end index is incremented by 1, since the top
-            # index is always excluded by definition.
-            current_lsrs = lsr_reports.iloc[start_idx : end_idx + 1]
-
-            # Process the current batch of LSRs
-            try:
-                processed_lsrs = gpt.classify_lsr_remarks(current_lsrs['remark'],
-                                                          impact_defs,
-                                                          temperature=0,
-                                                          wait_time=WAIT_TIME,
-                                                          verbose=True)
-            except (RateLimitError,
-                    ServiceUnavailableError,
-                    APIError,
-                    OSError) as e:
-                print(f"ERROR! - The following eception occurred:\n\t {e}")
-                print("Waiting 10s and retrying once before breaking!")
-                gpt.wait_timeout(10)
-                processed_lsrs = gpt.classify_lsr_remarks(current_lsrs['remark'],
-                                                          impact_defs,
-                                                          temperature=0,
-                                                          wait_time=WAIT_TIME,
-                                                          verbose=True)
-
-            # Write the current batch's result as a JSON file, identified by
-            # the lsr_uuid string and the current batch's ID, in the desired
-            # output results folder
-            batch_filename = f"{lsr_uuid}_{batch_id}.json"
-            batch_path = os.path.join(RESULTS_OUTPUT, batch_filename)
-            impacts.write_results_json(processed_lsrs, batch_path)
-
+    # The batches that have already been processed are skipped
+    # if verbose:
+    if batches_skipped:
+        print(f"WARNING: Skipping {batches_skipped}/{num_batches} batches "
+              f"- already processed")
+
+    # For each batch that has not been processed yet, along with its start and
+    # end indices for the LSR DataFrame
+    for batch_id, start_idx, end_idx in batches.pending():
+        # Stop before any batch after MAX_BATCHES, if MAX_BATCHES > 0
+        if MAX_BATCHES and batch_id > MAX_BATCHES:
             # if verbose:
-            print(f"Wrote partial results file: {batch_path}")
+            print(f"WARNING: MAX_BATCHES of {MAX_BATCHES} reached! HALTING!\n")
+            break
 
-            # Mark batch as processed:
-            batches[batch_id]["processed"] = True
+        # if verbose:
+        print(f"Batch ID: {batch_id}")
 
-            # Keep track of how many batches were processed
-            batches_processed += 1
+        # if verbose:
+        print(f"Indices: ({start_idx},{end_idx})")
+
+        # Subset the LSR reports to only select the reports for this batch.
+        # Notice that the end index is incremented by 1, since the top
+        # index is always excluded by definition.
+        current_lsrs = lsr_reports.iloc[start_idx : end_idx + 1]
+
+        # Process the current batch of LSRs, retrying with exponential
+        # backoff in case of transient API errors
+        processed_lsrs = gpt.with_backoff(
+            gpt.classify_lsr_remarks,
+            remarks[start_idx : end_idx + 1],
+            impact_defs,
+            client=client,
+            runner=runner,
+            temperature=0,
+            max_in_flight=MAX_IN_FLIGHT,
+            limiter=limiter,
+            cache=cache,
+            remarks_per_request=REMARKS_PER_REQUEST,
+            verbose=True)
+
+        # Write the current batch's result as a JSON file, identified by
+        # the lsr_uuid string and the current batch's ID, in the desired
+        # output results folder
+        batch_filename = f"{lsr_uuid}_{batch_id}.json"
+        batch_path = os.path.join(RESULTS_OUTPUT, batch_filename)
+        pending_writes.append(writer.submit(impacts.write_results_json,
+                                            processed_lsrs, batch_path))
 
-            # if verbose:
-            print(f"Processed {len(processed_lsrs)} for"
-                  f"batch {batch_id + 1}/{num_batches}")
+        # if verbose:
+        print(f"Queued partial results file: {batch_path}")
+
+        # Append the current batch's classified LSRs to the CSV file, unless
+        # it will be rebuilt. Since the writer has a single thread, this
+        # always happens after the JSON file above has been written
+        if not rebuild_csv:
+            pending_writes.append(writer.submit(
+                impacts.append_results_csv,
+                impacts.merge_batch_results(current_lsrs, processed_lsrs),
+                classified_path))
+
+        # Mark batch as processed:
+        batches.processed[batch_id] = True
+
+        # Update the progress file, once the batch results have been
+        # written, along with the new size of the CSV file
+        pending_writes.append(writer.submit(
+            impacts.write_progress,
+            batches.processed_ids(),
+            progress_path,
+            classified_path))
+
+        # Keep track of how many batches were processed
+        batches_processed += 1
 
-        # Break after MAX_BATCHES, if MAX_BATCHES > 0
-        if MAX_BATCHES and batch_id == MAX_BATCHES:
-            # if verbose:
-            print(f"WARNING: MAX_BATCHES of {MAX_BATCHES} reached! HALTING!\n")
-            break
+        # if verbose:
+        print(f"Processed {len(processed_lsrs)} for"
+              f"batch {batch_id + 1}/{num_batches}")
+
+    # Wait for all the pending writes to finish, raising any error they found
+    writer.shutdown(wait=True)
+    for pending_write in pending_writes:
+        pending_write.result()
+
+    # If needed, rebuild the classified LSRs CSV file from the batch result
+    # files, in the order of the LSRs, and save it to the progress file
+    if rebuild_csv:
+        result_files = impacts.read_batch_results(
+            lsr_uuid, RESULTS_OUTPUT, batch_ids=batches.processed_ids())
+        write_classified_csv(result_files, lsr_reports, batches,
+                             classified_path)
+        impacts.write_progress(batches.processed_ids(), progress_path,
+                               classified_path)
 
     # Keep track of how many total LSRs were processed
     if processed_lsrs:
@@ -169,69 +349,45 @@ def main():
           f"processed {batches_processed}/{num_batches} batches\n\t"
           f"skipped {batches_skipped}/{num_batches} batches \n\t"
           f"processed {total_processed} LSRs")
+    print(f"Classified LSRs written to: {classified_path}")
 
-    # Consolidate processed JSON results into a single CSV file
-
-    # Check if there are any JSON files in the current output path
-    result_files = impacts.get_files_in_dir(RESULTS_OUTPUT, extension=".json")
-    # Make sure that the JSON files found match the current UUID
-    result_files = list(filter(lambda x: lsr_uuid in x, result_files))
 
-    # If the list of result files in the output folder, with the requested uuid
-    # is empty, notify that no batch results were found
-    if not result_files:
-        print("ERROR: No batch result files were found for current uuid!")
+def write_classified_csv(result_files, lsr_reports, batches,
+                         classified_path):
+    '''Write the classified LSRs CSV file from the results of its batches.
 
-    # Else if there are result files in the output folder
-    else:
-        # Create a copy of the original LSR DataFrame
-        output_lsrs = lsr_reports.copy()
-        #output_lsrs.index = output_lsrs.remark
-        # Create the new columns for the new results data in the DataFrame
-        output_lsrs["MINOR"] = None
-        output_lsrs["MODERATE"] = None
-        output_lsrs["SERIOUS"] = None
-        output_lsrs["SEVERE"] = None
-        output_lsrs["CATASTROPHIC"] = None
-        output_lsrs["FFSI"] = None
-        output_lsrs["EXTRA"] = None
-        # For each of these files
-        for json_file in result_files:
-            # Read the results JSON file
-            batch_results = impacts.read_json_results(json_file)
-            # Get the current batch ID from the batch results file
-            batch_id = json_file.split("/")[-1].split('_')[-1].split('.')[0]
-            # Get the LSR dataframe ID corresponding to the beginning of the
-            # current batch
-            start_index = int(batch_id) * BATCH_SIZE
-            # Iterate over each result, and add the data to the corresponding
-            # columns in the output LSR dataframe, for the corresponding LSR
-            for batch_index in batch_results:
-                idx = start_index + int(batch_index)
-                p_min = batch_results[batch_index][1]["MINOR"]
-                p_mod = batch_results[batch_index][1]["MODERATE"]
-                p_ser = batch_results[batch_index][1]["SERIOUS"]
-                p_sev = batch_results[batch_index][1]["SEVERE"]
-                p_cat = batch_results[batch_index][1]["CATASTROPHIC"]
-                score = batch_results[batch_index][2]
-                extra = batch_results[batch_index][3]
-                output_lsrs.loc[idx]["MINOR"] = p_min / 100
-                output_lsrs.loc[idx]["MODERATE"] = p_mod / 100
-                output_lsrs.loc[idx]["SERIOUS"] = p_ser / 100
-                output_lsrs.loc[idx]["SEVERE"] = p_sev / 100
-                output_lsrs.loc[idx]["CATASTROPHIC"] = p_cat / 100
-                output_lsrs.loc[idx]["FFSI"] = score
-                output_lsrs.loc[idx]["EXTRA"] = extra
-
-        output_lsrs.reset_index(drop=True)
-        output_lsrs.to_csv(f"./results/{lsr_uuid}_classified.csv", index=False)
-
-        print("DONE!")
+    The results of each batch, given as a list of (<batch_id>,
+    <batch_results>) tuples sorted by batch ID (as returned by
+    impacts.read_batch_results()), are appended to a temporary CSV file,
+    which then replaces the classified LSRs CSV file at once.
+    '''
+    # Append the results of each batch, in order, to a temporary CSV file,
+    # which then replaces the classified LSRs CSV file at once
+    temp_path = classified_path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    for batch_id, batch_results in result_files:
+        # Get the LSRs corresponding to the current batch, from the start and
+        # end indices already defined for it
+        start_idx = batches.starts[batch_id]
+        end_idx = batches.ends[batch_id]
+        batch_lsrs = lsr_reports.iloc[start_idx : end_idx + 1]
+        impacts.append_results_csv(
+            impacts.merge_batch_results(batch_lsrs, batch_results),
+            temp_path)
+    if os.path.exists(temp_path):
+        os.replace(temp_path, classified_path)
+    elif os.path.exists(classified_path):
+        os.remove(classified_path)
+
+    print(f"Rebuilt {classified_path} from {len(result_files)} "
+          f"batch result files")
 
 
 # Block of code which will be executed when this file is executed as a script
 if __name__ == '__main__':
-    # Run the main() function
-    main()
+    # Run the main() function, reconciling the processed batches with the
+    # results output folder if requested
+    main(reconcile="--reconcile" in sys.argv[1:])
     # Terminate with exit code 0!
     sys.exit(0)
@@ -1,13 +1,42 @@
 #!/usr/bin/env python3
 
+import asyncio
+import hashlib
 import json
-from sys import stdout
-from time import sleep
+import random
+import sqlite3
+from time import monotonic, sleep
+
+import orjson
 from numpy import isnan
 
-from openai import ChatCompletion
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+from impacts_common import IMPACT_CLASSES, ffsi_score
+
+# Transient errors for which a failed API request is worth retrying
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError,
+                    OSError)
+
+# Result returned for EMPTY LSR remarks, holding a classification dictionary of
+# zero probabilities, and an EXTRA string reporting the missing remark
+# WARNING: THIS IS SPECIFIC TO FFSI CLASSES; YOU MAY NEED TO CHANGE THIS!
+EMPTY_RESULT = ('{"MINOR": 0, "MODERATE": 0, "SERIOUS": 0, "SEVERE": 0, '
+                '"CATASTROPHIC": 0}NO REMARK FOR THIS LSR!')
 
-from impacts_common import ffsi_score
+# Default path of the SQLite database file used to cache GPT API results
+DEFAULT_CACHE_FILE = './results/gpt_cache.db'
+
+# Decoder used to parse the JSON answers embedded in GPT responses
+JSON_DECODER = json.JSONDecoder()
+
+# Instructions prepended to the numbered queries, when several queries are sent
+# to the API in a single request
+BATCH_INSTRUCTIONS = ("Answer each of the following numbered texts "
+                      "independently. Return a single JSON array holding one "
+                      "answer per text, each answer being the JSON object "
+                      "requested above, with an additional \"idx\" key set to "
+                      "the number of its text.\n\n")
 
 
 def read_api_key(json_file_path):
@@ -25,11 +54,54 @@ def read_api_key(json_file_path):
     return openai_key["secret_key"]
 
 
-def query_gpt(query, role="user", system_task={}, temperature=1, top_p=1):
-    ''' Query the GPY API and return the first completion result.
+async def request_completion(client, message_list, temperature=1, top_p=1,
+                             limiter=None, verbose=False):
+    ''' Send a list of messages to the GPT API and return the first completion.
 
-    Function that queries the GPT API, and returns the first completion
-    produced as a response to the query.
+    Coroutine that waits for the rate limiter (if any) to allow the request,
+    sends the message list to the GPT API through the AsyncOpenAI client, and
+    returns the content of the first completion received. The same client
+    should be reused for all requests, so that its pool of connections to the
+    API is kept alive between them. If verbose, the number of prompt tokens
+    (and how many of them were served from the prompt cache) is printed out.
+    '''
+    # Wait for the rate limiter to allow this request, estimating the tokens
+    # it will use from its prompt length plus room for the answer
+    if limiter:
+        prompt_length = sum(len(m["content"]) for m in message_list)
+        await limiter.acquire(est_tokens=prompt_length // 4 + 500)
+
+    # Generate and receive back a ChatGPT completion for the GPT API
+    completion = await client.chat.completions.create(
+        # Use the GPT-3.5-turbo model
+        model="gpt-3.5-turbo",
+        messages=message_list,
+        temperature=temperature,
+        top_p=top_p
+    )
+
+    # Report how much of the prompt was served from the prompt cache, if the
+    # API reported its usage at all
+    usage = completion.usage
+    if verbose and usage is not None:
+        cached_tokens = getattr(usage.prompt_tokens_details, "cached_tokens",
+                                None) or 0
+        print(f"Prompt tokens: {usage.prompt_tokens} "
+              f"({cached_tokens} cached)")
+
+    # Return the first completion produced by our query to the API
+    return completion.choices[0].message.content
+
+
+async def query_gpt_async(client, query, role="user", system_task={},
+                          temperature=1, top_p=1, limiter=None, cache=None,
+                          verbose=False):
+    ''' Asynchronously query the GPT API and return the first completion.
+
+    Coroutine that queries the GPT API through an AsyncOpenAI client, and
+    returns the first completion produced as a response to the query. Awaiting
+    this coroutine does not block the event loop, so several queries can be in
+    flight at once.
 
     OpenAI's default values for temperature and top_p are maintained here as
     default values. From the official documentation:
@@ -48,14 +120,34 @@ def query_gpt(query, role="user", system_task={}, temperature=1, top_p=1):
         probability mass are considered.
 
         We generally recommend altering this or temperature but not both.
+
+    If a RateLimiter is passed as the limiter, the query waits until the API
+    request rate limits allow it to be sent. If a ResponseCache is passed as
+    the cache, results for previously seen queries are returned from it
+    without calling the API, and new results are stored in it.
+
+    The system task is always sent verbatim as the first message, so that
+    successive queries share an identical prompt prefix which the API can
+    serve from its prompt cache.
     '''
     # Process valid non-empty, non-blank string queries
     if query and query != " ":
+        # If a cache is provided, return the stored result for this query when
+        # it has already been answered
+        if cache:
+            cache_key = cache.make_key(system_task.get("content", ""), query)
+            cached_result = cache.get(cache_key)
+            if cached_result is not None:
+                if verbose:
+                    print("Result found in cache")
+                return cached_result
+
         # Message list for the API query
         message_list = []
 
         # If a system task is passed as parameter, make sure to first append it to
-        # the message_list
+        # the message_list, leaving it untouched so it matches the cached
+        # prompt prefix of previous queries
         if system_task:
             message_list.append(system_task)
 
@@ -63,70 +155,402 @@ def query_gpt(query, role="user", system_task={}, temperature=1, top_p=1):
         # Append the query to the message_list
         message_list.append({"role": role, "content": query})
 
-        # Generate and receive back a ChatGPT completion for the GPT API
-        completion = ChatCompletion.create(
-            # Use the GPT-3.5-turbo model
-            model="gpt-3.5-turbo",
-            messages=message_list,
-            temperature=temperature,
-            top_p=top_p
-        )
-
-        # Return the first completion produced by our query to the API
-        result = completion.choices[0].message.content
+        # Send the query, and receive back the first completion produced by
+        # the API
+        result = await request_completion(client,
+                                          message_list,
+                                          temperature=temperature,
+                                          top_p=top_p,
+                                          limiter=limiter,
+                                          verbose=verbose)
+
+        # Store the result, so this query is not sent to the API again, as
+        # long as it can be classified (a malformed result is not stored, so
+        # it doesn't break every later run)
+        if cache and is_valid_result(result):
+            cache.put(cache_key, result)
 
     # Handle EMPTY LSR remarks, by returning a classification dictionary of
     # zero probabilities, and an EXTRA string reporting the missing remark
-    # WARNING: THIS IS SPECIFIC TO FFSI CLASSES; YOU MAY NEED TO CHANGE THIS!
     else:
-        result = """{"MINOR": 0,
-                 "MODERATE": 0,
-                 "SERIOUS": 0,
-                 "SEVERE": 0,
-                 "CATASTROPHIC": 0
-                 }NO REMARK FOR THIS LSR!"""
+        result = EMPTY_RESULT
 
     # Return the result
     return result
 
 
-def wait_timeout(seconds=20):
-    ''' Wait (sleep) for a determined number of seconds and show countdown.
+async def query_gpt_batch_async(client, queries, role="user", system_task={},
+                                temperature=1, top_p=1, limiter=None,
+                                cache=None, verbose=False):
+    ''' Query the GPT API for several queries at once, in a single request.
+
+    Coroutine that sends a list of queries as a single numbered user message,
+    asking GPT to answer them with a JSON array holding one answer per query,
+    identified by an "idx" key. This returns a list with one result per
+    query, in the same format produced by query_gpt_async(), so a list of N
+    queries costs a single API request instead of N.
 
-    This function sleeps for a determined number of seconds, and logs to the
-    console a countdown progress of how much time remains in the waiting period
+    Queries found in the cache (if any) are not sent, and any query missing
+    from GPT's answer (or all of them, if the answer can't be parsed as a JSON
+    array) is sent again on its own through query_gpt_async().
+
+    Note that the results of queries answered in the JSON array hold only
+    their JSON answer, so that they never have any extra output (the EXTRA
+    of their classified remarks is always empty), unlike the results of
+    queries answered on their own.
+    '''
+    # List which will hold the result for each query
+    results = [None] * len(queries)
+
+    # If a cache is provided, fill in the results of queries already answered
+    cache_keys = [None] * len(queries)
+    if cache:
+        for i, query in enumerate(queries):
+            cache_keys[i] = cache.make_key(system_task.get("content", ""),
+                                           query)
+            results[i] = cache.get(cache_keys[i])
+
+    # Indices of the queries that still need to be sent to the API
+    pending = [i for i, result in enumerate(results) if result is None]
+
+    # If more than one query has to be sent, send them in a single request
+    if len(pending) > 1:
+        # Number the queries, so their answers can be matched back to them
+        numbered_queries = "\n".join(f"{n}. {queries[i]}"
+                                     for n, i in enumerate(pending, start=1))
+
+        # Message list for the API query, starting with the untouched system
+        # task, followed by the numbered queries
+        message_list = []
+        if system_task:
+            message_list.append(system_task)
+        message_list.append({"role": role,
+                             "content": BATCH_INSTRUCTIONS + numbered_queries})
+
+        if verbose:
+            print(f"Sending {len(pending)} queries in a single request")
+
+        # Send the queries, and receive back the answers for all of them
+        response = await request_completion(client,
+                                            message_list,
+                                            temperature=temperature,
+                                            top_p=top_p,
+                                            limiter=limiter,
+                                            verbose=verbose)
+
+        # Parse the JSON array of answers contained in the response
+        try:
+            start = response.index('[')
+            answers, _ = JSON_DECODER.raw_decode(response, start)
+        except ValueError:
+            answers = []
+            if verbose:
+                print(f"WARNING: could not parse batched response: {response}")
+
+        # Match each answer to the number of its query, only keeping answers
+        # numbered from 1 to the number of queries sent. Numbers answered
+        # more than once are ambiguous, and answers missing any class
+        # probability can't be classified, so all of their answers are dropped
+        numbered_answers = {}
+        rejected_numbers = set()
+        for answer in answers if isinstance(answers, list) else []:
+            try:
+                number = int(answer.pop("idx"))
+            except (ValueError, TypeError, KeyError, AttributeError):
+                continue
+            if not 1 <= number <= len(pending):
+                continue
+            if number in numbered_answers:
+                rejected_numbers.add(number)
+            numbered_answers[number] = answer
+            if not has_impact_probs(answer):
+                rejected_numbers.add(number)
+        for number in rejected_numbers:
+            del numbered_answers[number]
+
+        # Store the result of each query that was answered, as its JSON
+        # answer alone (any text around the array can't be attributed to a
+        # single query, so it is dropped)
+        for number, answer in numbered_answers.items():
+            i = pending[number - 1]
+            results[i] = orjson.dumps(answer).decode()
+            if cache:
+                cache.put(cache_keys[i], results[i])
+
+        if verbose and len(numbered_answers) < len(pending):
+            print(f"WARNING: {len(pending) - len(numbered_answers)} queries "
+                  f"were not answered in the batched response")
+
+    # Send any query that still has no result on its own
+    for i, result in enumerate(results):
+        if result is None:
+            results[i] = await query_gpt_async(client,
+                                               queries[i],
+                                               role=role,
+                                               system_task=system_task,
+                                               temperature=temperature,
+                                               top_p=top_p,
+                                               limiter=limiter,
+                                               cache=cache,
+                                               verbose=verbose)
+
+    # Return the results
+    return results
+
+
+def query_gpt(client, query, role="user", system_task={}, temperature=1,
+              top_p=1, limiter=None, cache=None, runner=None, verbose=False):
+    ''' Query the GPT API and return the first completion result.
+
+    Blocking wrapper around query_gpt_async(), for callers that are not
+    running inside an event loop. The query is run by the asyncio.Runner
+    passed as the runner, if any, so that successive calls can share the
+    same event loop (which the client's connections are bound to).
+    '''
+    run = runner.run if runner else asyncio.run
+    return run(query_gpt_async(client,
+                               query,
+                               role=role,
+                               system_task=system_task,
+                               temperature=temperature,
+                               top_p=top_p,
+                               limiter=limiter,
+                               cache=cache,
+                               verbose=verbose))
+
+
+def with_backoff(fn, *args, max_attempts=8, base=1.0, cap=60.0, **kw):
+    ''' Call a function, retrying it with exponential backoff on API errors.
+
+    This function calls fn(*args, **kw) and returns its result. If the call
+    raises one of the RETRYABLE_ERRORS, it sleeps for an exponentially
+    growing delay (base * 2^attempt seconds, capped at cap seconds, plus a
+    random jitter of up to base seconds) and tries again, for at most
+    max_attempts attempts before propagating the error. When a rate limit
+    error carries a Retry-After header, its value is used as the delay.
+    '''
+    for attempt in range(max_attempts):
+        try:
+            return fn(*args, **kw)
+        except RETRYABLE_ERRORS as e:
+            # Give up and propagate the error after the last attempt
+            if attempt == max_attempts - 1:
+                raise
+
+            # Exponential backoff delay, with a random jitter
+            delay = min(cap, base * 2 ** attempt) + random.uniform(0, base)
+
+            # Honor the Retry-After header of rate limit errors, if present
+            if isinstance(e, RateLimitError):
+                retry_after = e.response.headers.get("retry-after")
+                try:
+                    delay = float(retry_after)
+                except (TypeError, ValueError):
+                    pass
+
+            print(f"ERROR! - The following exception occurred:\n\t {e}")
+            print(f"Retrying in {delay:.1f}s "
+                  f"(attempt {attempt + 2}/{max_attempts})")
+            sleep(delay)
+
+
+class RateLimiter:
+    ''' Token bucket rate limiter for GPT API requests.
+
+    This class keeps two buckets, one for requests and one for tokens, which
+    hold at most rpm_capacity requests and tpm_capacity tokens respectively,
+    and are refilled at a rate of capacity/60 per second. Each API request
+    must acquire one request and its estimated tokens from the buckets before
+    being sent, so requests go out as fast as the rate limits allow, instead
+    of waiting a fixed time between them.
 
     GPT API Request rate limits are defined in terms of both Requests Per
     Minute (RPM) and Tokens Per Minute (TPM):
 
-    Free trial users: 3 RPM (20s timeout) / 150,000 TPM
-    Pay-as-you-go users: 60 RPM (1s timeout) / 250,000 TPM
+    Free trial users: 3 RPM / 150,000 TPM
+    Pay-as-you-go users: 60 RPM / 250,000 TPM
     '''
-    print("Waiting before querying the API again...")
-    for remaining in range(seconds, 0, -1):
-        stdout.write("\r")
-        stdout.write("{:2d} seconds remaining.".format(remaining))
-        stdout.flush()
-        sleep(1)
-    print("\n")
-
-
-def classify_lsr_remarks(lsr_remarks_list, impact_defs,
-                         temperature=1, top_p=1, wait_time=20,
-                         starting_idx=0, limit=0, verbose=False):
-    ''' Classify a list of LSR remarks using an impact definition and ChatGPT.
+    def __init__(self, rpm_capacity=3, tpm_capacity=150000):
+        self.rpm_capacity = rpm_capacity
+        self.tpm_capacity = tpm_capacity
+
+        # Both buckets start full
+        self.available_requests = rpm_capacity
+        self.available_tokens = tpm_capacity
+        self.last_update = monotonic()
+
+    def _refill(self):
+        ''' Refill both buckets according to the time since the last refill.
+        '''
+        now = monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+
+        self.available_requests = min(self.rpm_capacity,
+                                      self.available_requests
+                                      + elapsed * self.rpm_capacity / 60)
+        self.available_tokens = min(self.tpm_capacity,
+                                    self.available_tokens
+                                    + elapsed * self.tpm_capacity / 60)
+
+    async def acquire(self, est_tokens=0):
+        ''' Wait until one request and est_tokens tokens are available.
+        '''
+        # A request can never need more tokens than the bucket can hold
+        est_tokens = min(est_tokens, self.tpm_capacity)
+
+        while True:
+            self._refill()
+
+            # If both buckets have enough capacity, take it and return
+            if (self.available_requests >= 1
+                    and self.available_tokens >= est_tokens):
+                self.available_requests -= 1
+                self.available_tokens -= est_tokens
+                return
+
+            # Otherwise, sleep until both buckets should have refilled enough
+            wait_requests = ((1 - self.available_requests)
+                             * 60 / self.rpm_capacity)
+            wait_tokens = ((est_tokens - self.available_tokens)
+                           * 60 / self.tpm_capacity)
+            await asyncio.sleep(max(wait_requests, wait_tokens, 0))
+
+
+class ResponseCache:
+    ''' Persistent on-disk cache of GPT API results.
+
+    This class stores GPT results in a SQLite database file, keyed by a SHA-1
+    hash of the system task content and the query, so that repeated queries
+    (e.g. duplicated LSR remarks, or re-runs over the same LSR file) are
+    answered without sending a new request to the API.
+    '''
+    def __init__(self, db_path=DEFAULT_CACHE_FILE):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache "
+                                "(key TEXT PRIMARY KEY, result TEXT)")
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(system_content, query):
+        ''' Hash a system task content and a query into a cache key.
+        '''
+        return hashlib.sha1((system_content + "\x1f" + query).encode()
+                            ).hexdigest()
+
+    def get(self, key):
+        ''' Return the result stored for a key, or None if there is none.
+        '''
+        row = self.connection.execute("SELECT result FROM cache WHERE key = ?",
+                                      (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, result):
+        ''' Store the result for a key, replacing any previous one.
+        '''
+        self.connection.execute("INSERT OR REPLACE INTO cache (key, result) "
+                                "VALUES (?, ?)", (key, result))
+        self.connection.commit()
+
+    def close(self):
+        ''' Close the underlying database connection.
+        '''
+        self.connection.close()
+
+
+def is_empty_remark(remark):
+    ''' Check whether an LSR remark is empty, and can't be classified.
+
+    Remarks that are not strings (e.g. NaN values read from empty CSV cells),
+    or that only contain whitespace, are considered empty.
+    '''
+    if isinstance(remark, float) and isnan(remark):
+        return True
+    return not isinstance(remark, str) or not remark.strip()
+
 
-    This function queries ChatGPT for a classification based on a specific
-    impact definition (FFSI), for each LSR remark contained in the input list
-    received.
+def has_impact_probs(probs_dict):
+    ''' Check whether a classification dictionary holds all class probabilities.
 
-    This function returns a dictionary containing the original remarks, their
-    associated probabilistic classifications produced by ChatGPT using the
-    impact definitions, and its associated FFSI score.
+    Returns True if probs_dict is a dictionary holding a number for each of
+    the FFSI classes in IMPACT_CLASSES, so that it can be scored.
     '''
+    return (isinstance(probs_dict, dict) and
+            all(type(probs_dict.get(impact_class)) in (int, float)
+                for impact_class in IMPACT_CLASSES))
+
 
-    # Empty dictionary which will hold the results of the processed LSRs
-    processed_lsrs = {}
+def is_valid_result(result):
+    ''' Check whether a GPT result can be classified, before caching it.
+
+    Returns True if the result holds a JSON dictionary, decoded as in
+    parse_gpt_result(), with every class probability (see has_impact_probs()).
+    Results without any JSON dictionary (e.g. refusals) are only classified
+    with zero probabilities as a fallback, so they are not valid.
+    '''
+    try:
+        probs_dict, _ = JSON_DECODER.raw_decode(result, result.index('{'))
+    except ValueError:
+        return False
+    return has_impact_probs(probs_dict)
+
+
+def parse_gpt_result(result):
+    ''' Split a GPT result into its classification dictionary and extra text.
+
+    In case the GPT API response includes more text than the requested JSON
+    dictionary formatted answer, separate the dictionary portion from the rest
+    of the response, and return the remaining response as an "extra" string.
+    The dictionary is decoded in a single pass starting at the first '{' of
+    the response, so nested braces are handled correctly.
+    '''
+    try:
+        # Decode the classification results, starting at the first '{', and
+        # keep any extra output GPT may have generated after them
+        probs_dict, end = JSON_DECODER.raw_decode(result, result.index('{'))
+        response_extra = result[end:].strip()
+
+    # Handle non-classification outputs, which have only EXTRA GPT outputs
+    # WARNING: THIS IS SPECIFIC TO FFSI CLASSES; YOU MAY NEED TO CHANGE THIS!
+    except ValueError:
+        probs_dict = {"MINOR": 0,
+                      "MODERATE": 0,
+                      "SERIOUS": 0,
+                      "SEVERE": 0,
+                      "CATASTROPHIC": 0}
+        response_extra = result.strip()
+
+    # Return the probabilities dictionary along with the extra output
+    return probs_dict, response_extra
+
+
+async def iter_classified_remarks_async(lsr_remarks_list, impact_defs, client,
+                                        temperature=1, top_p=1,
+                                        max_in_flight=10, limiter=None,
+                                        cache=None, remarks_per_request=1,
+                                        starting_idx=0, limit=0,
+                                        verbose=False):
+    ''' Classify a list of LSR remarks using an impact definition and ChatGPT.
+
+    This asynchronous generator queries ChatGPT for a classification based on
+    a specific impact definition (FFSI), for each LSR remark contained in the
+    input list received, through an AsyncOpenAI client. All remarks are sent
+    concurrently, with at most max_in_flight requests waiting on the API at
+    any given time. If a RateLimiter is passed as the limiter, the requests
+    are also held back to comply with the API's request rate limits, and if a
+    ResponseCache is passed as the cache, remarks that were already
+    classified are not sent to the API again. When remarks_per_request is
+    greater than 1, remarks are grouped and sent remarks_per_request at a time
+    in a single request each.
+
+    As soon as the answer to each request is received, this generator yields
+    a tuple for each of its remarks, holding the remark's index in the list,
+    and a list with the original remark, its associated probabilistic
+    classification produced by ChatGPT using the impact definitions, its
+    associated FFSI score, and any extra GPT output. Tuples are therefore not
+    necessarily yielded in index order. If any of the queries fails, its
+    exception is raised right away, so the caller can retry the whole list.
+    '''
 
     # Initialize the ChatGPT system task based on the impact definitions
     initialization_task = {"role": "system", "content": impact_defs}
@@ -136,7 +560,7 @@ def classify_lsr_remarks(lsr_remarks_list, impact_defs,
         # If limit is provided, show a warning and wait a bit
         if limit:
             print("WARNING: only %i LSRs will be processed! \n" % limit)
-            sleep(2.5)
+            await asyncio.sleep(2.5)
 
         # Print out the system task
         print("SYSTEM TASK:\n", impact_defs, '\n')
@@ -151,57 +575,40 @@ def classify_lsr_remarks(lsr_remarks_list, impact_defs,
         if verbose:
             print("WARNING: starting at index %i, out of %i" % (starting_idx,
                                                                 total_lsrs))
-            sleep(2.5)
+            await asyncio.sleep(2.5)
 
         # Slice the LSR remarks to start at the new index
         lsr_remarks_list = lsr_remarks_list[starting_idx:]
-        # Update the number of total LSRs to be processed
-        total_lsrs = len(lsr_remarks_list)
-
-
-    # Query the ChatGPT API prepending the system task each time
-    for index, remark in enumerate(lsr_remarks_list):
 
-        if verbose:
-            print(f"Remark sent: {remark}")
+    # If a limit is provided, only classify the first x reports
+    if limit:
+        lsr_remarks_list = lsr_remarks_list[:limit]
 
-        # Construct and send the query, receiving the result
-        result = query_gpt(remark,
-                           role="user",
-                           system_task=initialization_task,
-                           temperature=temperature,
-                           top_p=top_p)
+    # Semaphore limiting how many API requests can be in flight at once
+    semaphore = asyncio.Semaphore(max_in_flight)
 
+    def classified_remark(index, remark, result):
+        # Build the processed LSR entry for a remark, from its GPT result
         if verbose:
             print(f"Result received: {result}")
 
-        # In case the GPT API response includes more text than the requested
-        # JSON dictionary formatted answer, separate the dictionary portion
-        # from the rest of the response, and add the remaining response as a
-        # "extra" in the result's dictionary
-
-        # Extract any extra output GPT may have generated
-        response_extra = result.split('}')[-1].split("\n\n")[-1]
+        # Separate the classification results from any extra output
+        probs_dict, response_extra = parse_gpt_result(result)
 
-        # Extract the classification results
-        response_classes = result.split('{')[-1].split('}')[0]
-
-        # Handle non-classification outputs, which have only EXTRA GPT outputs
-        if response_classes == response_extra:
-            response_classes = """"MINOR": 0,
-                               "MODERATE": 0,
-                               "SERIOUS": 0,
-                               "SEVERE": 0,
-                               "CATASTROPHIC": 0"""
-        response_json = '{' + response_classes + '}'
+        # Handle answers whose JSON dictionary lacks some of the impact class
+        # probabilities like non-classification outputs, keeping the whole
+        # answer as EXTRA GPT output, so that they can be reviewed later
+        if not has_impact_probs(probs_dict):
+            print(f"WARNING: GPT result for LSR {index} could not be "
+                  f"classified: {result!r}")
+            probs_dict = dict.fromkeys(IMPACT_CLASSES, 0)
+            response_extra = result.strip()
 
         if verbose:
+            response_json = orjson.dumps(probs_dict).decode()
             print(f"Response JSON: \n\t{response_json}")
             print(f"Response EXTRA: \n\t{response_extra}\n")
 
-        # Read the resulting probabilities in JSON format as a dictionary
-        probs_dict = json.loads(response_json)
-
         # Calculate the FFSI score for the current classification results
         score = ffsi_score(probs_dict)
 
@@ -214,20 +621,112 @@ def classify_lsr_remarks(lsr_remarks_list, impact_defs,
                   "SCORE: %s\n" % str(score),
                   "EXTRA: %s\n" % response_extra)
 
-        # Add the current results to the output LSRs dictionary
-        processed_lsrs[index] = [remark, probs_dict, score, response_extra]
-
-        # If a limit is provided, stop classifyig LSRs after x reports
-        if limit:
-            # if the current index is equal to the limit, stop the loop
-            if index == limit - 1:
-                break
+        return [remark, probs_dict, score, response_extra]
+
+    async def query_remarks(indexed_remarks):
+        # Construct and send the query for a group of remarks, once a request
+        # slot is available
+        remarks = [remark for _, remark in indexed_remarks]
+        async with semaphore:
+            if verbose:
+                for remark in remarks:
+                    print(f"Remark sent: {remark}")
+
+            # Send single remarks on their own
+            if len(remarks) == 1:
+                results = [await query_gpt_async(
+                    client,
+                    remarks[0],
+                    role="user",
+                    system_task=initialization_task,
+                    temperature=temperature,
+                    top_p=top_p,
+                    limiter=limiter,
+                    cache=cache,
+                    verbose=verbose)]
+            else:
+                results = await query_gpt_batch_async(
+                    client,
+                    remarks,
+                    role="user",
+                    system_task=initialization_task,
+                    temperature=temperature,
+                    top_p=top_p,
+                    limiter=limiter,
+                    cache=cache,
+                    verbose=verbose)
+
+            # Return the group's results, along with its indexed remarks
+            return indexed_remarks, results
+
+    # Separate the empty remarks, which don't need to be sent to the API, from
+    # the rest of the remarks, keeping track of their indices
+    indexed_remarks = list(enumerate(lsr_remarks_list))
+    non_empty = [(index, remark) for index, remark in indexed_remarks
+                 if not is_empty_remark(remark)]
+
+    # Yield the empty remarks right away, classified with zero probabilities
+    for index, remark in indexed_remarks:
+        if is_empty_remark(remark):
+            yield index, classified_remark(index, remark, EMPTY_RESULT)
+
+    # Split the non-empty remarks into groups of remarks_per_request remarks,
+    # each of which will be sent to the API as a single request
+    remarks_per_request = max(remarks_per_request, 1)
+    tasks = [asyncio.ensure_future(
+                 query_remarks(non_empty[start:start + remarks_per_request]))
+             for start in range(0, len(non_empty), remarks_per_request)]
+
+    # Query the ChatGPT API for all the groups of remarks at once, prepending
+    # the system task each time, and process each group as soon as it is
+    # answered. Any failed query is propagated, so the whole list can be
+    # retried
+    try:
+        for next_group in asyncio.as_completed(tasks):
+            group_remarks, results = await next_group
+
+            # Yield the current results
+            for (index, remark), result in zip(group_remarks, results):
+                yield index, classified_remark(index, remark, result)
+
+    # If a query failed (or the results are no longer wanted), cancel the
+    # queries still in flight, and wait for them to finish, so that they
+    # don't keep running on the event loop, and sending requests, while the
+    # list is retried
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def classify_lsr_remarks_async(lsr_remarks_list, impact_defs, **kwargs):
+    ''' Classify a list of LSR remarks using an impact definition and ChatGPT.
 
-        # If there are still remarks to process, wait some time to comply with
-        # the API's request rate limits
-        if index < total_lsrs - 1:
-            # Wait wait_time seconds (X requests/min rate limit)
-            wait_timeout(wait_time)
+    This coroutine consumes iter_classified_remarks_async(), which accepts the
+    same keyword arguments, and returns a dictionary containing the original
+    remarks, their associated probabilistic classifications produced by
+    ChatGPT using the impact definitions, and its associated FFSI score, keyed
+    by the remarks' index.
+    '''
+    # Collect the processed LSRs in a dictionary, sorted by index
+    processed_lsrs = {index: processed_lsr
+                      async for index, processed_lsr
+                      in iter_classified_remarks_async(lsr_remarks_list,
+                                                       impact_defs, **kwargs)}
 
     # Return the processed LSRs
-    return processed_lsrs
+    return dict(sorted(processed_lsrs.items()))
+
+
+def classify_lsr_remarks(lsr_remarks_list, impact_defs, runner=None, **kwargs):
+    ''' Classify a list of LSR remarks using an impact definition and ChatGPT.
+
+    Blocking wrapper around classify_lsr_remarks_async(), which accepts the
+    same keyword arguments. The classification is run by the asyncio.Runner
+    passed as the runner, if any, so that successive calls can share the same
+    event loop (which the client's connections are bound to).
+    '''
+    run = runner.run if runner else asyncio.run
+    return run(classify_lsr_remarks_async(lsr_remarks_list, impact_defs,
+                                          **kwargs))
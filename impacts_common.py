@@ -1,18 +1,119 @@
 #!/usr/bin/env python3
 
-import csv
-import json
+import base64
+import glob
+import hashlib
 import os
-
-from numpy import round, nan
-from pandas import read_csv, to_datetime
-from shortuuid import uuid
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from operator import itemgetter
+from types import MappingProxyType
+
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+from numpy import (arange, asarray, dot, flatnonzero, minimum, ndarray,
+                   round, zeros)
+from pandas import DataFrame, RangeIndex, Series, to_datetime
+
+# Standard names for the columns of the "standard" LSR CSV files, as they are
+# provided by the Iowa State Univeristy Local Storm Report Archive, without
+# and with a category column, and of the Expertly-Classified (IBW) LSR files
+STANDARD_COLUMNS = ("valid", "valid2", "lat", "lon", "mag", "wfo",
+                    "typecode", "typetext", "city", "county", "state",
+                    "source", "remark", "ugc", "ugcname")
+CATEGORY_COLUMNS = ("valid", "valid2", "lat", "lon", "mag", "wfo",
+                    "typecode", "typetext", "city", "county", "state",
+                    "source", "remark", "category", "ugc", "ugcname")
+IBW_COLUMNS = ("time", "office", "local_time", "county", "location", "state",
+               "event_type", "magnitude", "source", "lat", "lon", "remark")
+
+# PyArrow type used to read categorical columns, as dictionary-encoded strings
+# which are converted to Pandas categorical data
+CATEGORICAL_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+# Columns of the standard and IBW LSR CSV files which hold categorical data
+STANDARD_CATEGORICAL_COLUMNS = ("source", "category", "wfo", "typecode",
+                                "state")
+IBW_CATEGORICAL_COLUMNS = ("source", "magnitude", "office")
+
+# PyArrow type used to read dates and times, along with the formats they are
+# parsed from, tried in order: ISO 8601, then those found in the LSR archives.
+# These are shared by every date and time column, of every LSR reader
+TIMESTAMP_TYPE = pa.timestamp('s')
+TIMESTAMP_FORMATS = ['%Y/%m/%d %H:%M', '%m/%d/%y %H:%M']
+TIMESTAMP_PARSERS = [pv.ISO8601] + TIMESTAMP_FORMATS
+
+# Explicit formats of the ISO 8601 dates and times accepted by PyArrow's
+# parser, for the readers which cannot use it (e.g. Polars, or Pandas when
+# PyArrow fails to parse a column), tried before TIMESTAMP_FORMATS
+ISO8601_FORMATS = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S',
+                   '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M']
+
+# Format of the local times of the IBW LSR files (e.g. "7/27/22 9:26 PM"),
+# which are read as strings and parsed with Pandas, since PyArrow cannot parse
+# 12-hour times without zero-padding
+IBW_LOCAL_TIME_FORMAT = '%m/%d/%y %I:%M %p'
+
+# PyArrow types of the columns of the standard (with or without a category
+# column) and IBW LSR CSV files, when all of them are read as strings, and
+# when the DataFrame is indexed, so that dates and times, and categorical
+# data, are read as such. Types given for columns which are not in a file are
+# ignored by PyArrow
+STANDARD_COLUMN_TYPES = MappingProxyType(
+    {column_name: pa.string() for column_name in CATEGORY_COLUMNS})
+STANDARD_INDEXED_COLUMN_TYPES = MappingProxyType(
+    {**STANDARD_COLUMN_TYPES,
+     **{column_name: CATEGORICAL_TYPE
+        for column_name in STANDARD_CATEGORICAL_COLUMNS},
+     "valid2": TIMESTAMP_TYPE})
+IBW_COLUMN_TYPES = MappingProxyType(
+    {column_name: pa.string() for column_name in IBW_COLUMNS})
+IBW_INDEXED_COLUMN_TYPES = MappingProxyType(
+    {**IBW_COLUMN_TYPES,
+     **{column_name: CATEGORICAL_TYPE
+        for column_name in IBW_CATEGORICAL_COLUMNS},
+     "time": TIMESTAMP_TYPE})
+
+# Names of the FFSI impact classes, in increasing order of severity, along
+# with a function which gets their probabilities from a dictionary at once
+IMPACT_CLASSES = ("MINOR", "MODERATE", "SERIOUS", "SEVERE", "CATASTROPHIC")
+GET_IMPACT_PROBS = itemgetter(*IMPACT_CLASSES)
+
+# Weight of each FFSI impact class in the FFSI score (from 1 to 5), with the
+# conversion of its probability from percent already applied
+FFSI_WEIGHTS = arange(1, len(IMPACT_CLASSES) + 1, dtype=float) / 100
+
+# Size in bytes of the blocks read at a time when streaming a CSV file
+CSV_BLOCK_SIZE = 8 << 20
+
+# Alphabet of the file name UUIDs generated by earlier versions, which used
+# shortuuid (see legacy_hash_filename())
+LEGACY_UUID_ALPHABET = ("23456789ABCDEFGHJKLMNPQRSTUVWXYZ"
+                        "abcdefghijkmnopqrstuvwxyz")
 
 
 def read_textual_definition(text_file_path):
     ''' Read a text file containing an FFSI definition.
 
-    This function reads an textfile into a multiline string object.
+    This function reads an textfile into a multiline string object. Files
+    which have already been read are returned from a cache, unless they have
+    been modified since.
+    '''
+    return read_cached_definition(os.path.abspath(text_file_path),
+                                  os.path.getmtime(text_file_path))
+
+
+@lru_cache(maxsize=32)
+def read_cached_definition(text_file_path, modification_time):
+    ''' Read a text file containing an FFSI definition, caching its contents.
+
+    The contents are cached by file path and modification time, so that a
+    file is only read again when it changes.
     '''
     with open(text_file_path) as text_file:
         ffsi_definition = text_file.read()
@@ -26,125 +127,364 @@ def read_lsr_remarks(lsr_file_path, column_name='REMARK'):
     This function reads a CSV file containing Local Storm Reports, and returns
     a list of 'remarks' contained in the 'REMARK' column.
     '''
-    # Open the CSV file
-    lsr_file = open(lsr_file_path)
+    # Read only the requested column from the memory-mapped CSV file, as
+    # strings
+    with pa.memory_map(lsr_file_path) as lsr_file:
+        lsrs = pv.read_csv(lsr_file,
+                           convert_options=pv.ConvertOptions(
+                               include_columns=[column_name],
+                               column_types={column_name: pa.string()}))
+
+    # Return the LSR remarks, as a list
+    return lsrs.column(column_name).to_pylist()
+
+
+def lsr_csv_options(column_names, column_types=None):
+    ''' Define the PyArrow CSV options used to read a collection of LSRs.
+
+    This function returns the read, parse, and convert options for PyArrow's
+    CSV readers, naming the columns as in column_names (the file's own header
+    row is skipped). Columns are read with the PyArrow types given for them
+    in the column_types mapping (such as STANDARD_COLUMN_TYPES), or as
+    strings if no mapping is given, and empty fields are read as nulls.
+    Timestamp columns are parsed according to the formats in
+    TIMESTAMP_PARSERS.
+    '''
+    # Read every column as a string, unless requested otherwise
+    if column_types is None:
+        column_types = {column_name: pa.string()
+                        for column_name in column_names}
+
+    # Define standard names for each columns, as well as appropriate data
+    # types
+    return (pv.ReadOptions(column_names=list(column_names), skip_rows=1),
+            pv.ParseOptions(delimiter=','),
+            pv.ConvertOptions(column_types=column_types,
+                              timestamp_parsers=TIMESTAMP_PARSERS,
+                              strings_can_be_null=True,
+                              null_values=['']))
+
+
+def fill_blank_remarks(lsr_table):
+    ''' Replace the empty remarks of a PyArrow Table of LSRs with blanks.
+
+    This function replaces all the nulls in the 'remark' column of a PyArrow
+    Table containing Local Storm Reports (empty remarks) with blank strings
+    " ", returning the resulting Table. Empty remarks are read as nulls by
+    the CSV reader, so they are only marked in the column's validity bitmap,
+    and a Table without any of them is returned as is, without copying it.
+    '''
+    remarks = lsr_table['remark']
+    if not remarks.null_count:
+        return lsr_table
 
-    # Create a DictReader object
-    lsrs = csv.DictReader(lsr_file)
+    remark_index = lsr_table.schema.get_field_index('remark')
+    return lsr_table.set_column(remark_index, 'remark',
+                                pc.fill_null(remarks, ' '))
 
-    # List to hold the LSR remarks
-    remarks = []
 
-    # Iterate over each report, and append its remark to the remarks list
-    for report in lsrs:
-        remarks.append(report[column_name])
+def parse_datetimes(values, datetime_formats, errors='raise'):
+    ''' Parse a Pandas Series of strings into dates and times.
 
-    # Return the LSR remarks
-    return remarks
+    Each value is parsed with the first of datetime_formats it matches, and
+    the values which match none of them are parsed by Pandas, inferring their
+    format. Values which cannot be parsed at all raise an error, or are
+    returned as NaT if errors='coerce'. Nulls are returned as NaT.
+    '''
+    # Parse every value with the first format, and then only those which did
+    # not match with the next ones
+    values = Series(values)
+    datetimes = to_datetime(values, format=datetime_formats[0],
+                            errors='coerce', cache=True)
+    for datetime_format in datetime_formats[1:]:
+        unparsed = datetimes.isna() & values.notna()
+        if not unparsed.any():
+            break
+        datetimes[unparsed] = to_datetime(values[unparsed],
+                                          format=datetime_format,
+                                          errors='coerce', cache=True)
+
+    # Leave the values which match no format to Pandas
+    unparsed = datetimes.isna() & values.notna()
+    if unparsed.any():
+        datetimes[unparsed] = to_datetime(values[unparsed], errors=errors,
+                                          cache=True)
+
+    return datetimes
+
+
+def read_lsr_table(lsr_file_path, column_names, column_types=None):
+    ''' Read a CSV file containing a collection of LSRs into a PyArrow Table.
+
+    This function reads a CSV file containing Local Storm Reports using
+    PyArrow's CSV reader, with the options defined by lsr_csv_options(). Empty
+    fields are read as nulls, except in the 'remark' column, where empty
+    remarks are replaced with blank strings " ".
+
+    If a date and time column (of type TIMESTAMP_TYPE) holds values which
+    none of TIMESTAMP_PARSERS can parse, the file is read again with those
+    columns as strings, which are then parsed by parse_datetimes() with the
+    same formats (ISO8601_FORMATS and TIMESTAMP_FORMATS), and the values
+    which still cannot be parsed are read as nulls, with a warning.
+    '''
+    # Read the memory-mapped file, and define standard names for each columns,
+    # as well as appropriate data types
+    try:
+        lsr_table = read_csv_table(lsr_file_path, column_names, column_types)
+    except pa.ArrowInvalid:
+        timestamp_columns = [column_name for column_name in column_names
+                             if column_types and
+                             column_types.get(column_name) == TIMESTAMP_TYPE]
+        if not timestamp_columns:
+            raise
+
+        # Read the date and time columns as strings, and parse them with
+        # Pandas, so that a few unexpected values do not prevent the whole
+        # file from being read
+        lsr_table = read_csv_table(
+            lsr_file_path, column_names,
+            {**column_types,
+             **{column_name: pa.string()
+                for column_name in timestamp_columns}})
+        for column_name in timestamp_columns:
+            values = lsr_table[column_name].to_pandas()
+            datetimes = parse_datetimes(values,
+                                        ISO8601_FORMATS + TIMESTAMP_FORMATS,
+                                        errors='coerce')
+            invalid_count = int((datetimes.isna() & values.notna()).sum())
+            if invalid_count:
+                print(f"WARNING: {invalid_count} value(s) of '{column_name}' "
+                      f"in {lsr_file_path} could not be parsed as dates "
+                      f"and times, and were read as nulls")
+            lsr_table = lsr_table.set_column(
+                lsr_table.column_names.index(column_name), column_name,
+                pa.array(datetimes, type=TIMESTAMP_TYPE))
+
+    # Replace all nulls in the remarks column (empty remarks) with blank
+    # strings " "
+    return fill_blank_remarks(lsr_table)
+
+
+def read_csv_table(lsr_file_path, column_names, column_types=None):
+    ''' Read a CSV file into a PyArrow Table, as is.
+
+    The file is memory-mapped, and read with the options defined by
+    lsr_csv_options().
+    '''
+    read_options, parse_options, convert_options = lsr_csv_options(
+        column_names, column_types)
+    with pa.memory_map(lsr_file_path) as lsr_file:
+        return pv.read_csv(lsr_file,
+                           read_options=read_options,
+                           parse_options=parse_options,
+                           convert_options=convert_options)
 
 
-def read_standard_lsrs(lsr_file_path, no_index=True, no_category=True):
+def read_standard_lsrs(lsr_file_path, no_index=True, no_category=True,
+                       backend='pandas', as_arrow=False):
     """ Read a standard CSV file containing a collection of LSRs
 
     This function reads a "standard" CSV format containing LSR reports, as they
     are provided by the Iowa State Univeristy Local Storm Report Archive:
     https://mesonet.agron.iastate.edu/request/gis/lsrs.phtml
+
+    With backend='polars', the file is read into a Polars DataFrame instead
+    of a Pandas one (see read_standard_lsrs_polars()). With as_arrow=True, the
+    PyArrow Table the file is parsed into is returned as is, without
+    converting it to a Pandas DataFrame, so that only the columns which are
+    needed (such as 'remark') have to be converted later. Since a Table has
+    no index, 'valid2' is then kept as a column, even if no_index is False.
     """
-    # Read the file, and define standard names for each columns, as well as
-    # approrpiate data types
-    if no_category:
-        standard_lsrs = read_csv(lsr_file_path, delimiter=',', header=0,
-                                names=["valid", "valid2", "lat", "lon",
-                                        "mag", "wfo", "typecode", "typetext",
-                                        "city", "county", "state", "source",
-                                        "remark", "ugc", "ugcname"],
-                                index_col=False,#"valid2",
-                                dtype={"valid": str, "valid2": str,
-                                        "lat": str, "lon": str,
-                                        "mag": str, "wfo": str, "typecode": str,
-                                        "typetext": str, "city": str,
-                                        "county": str, "state": str, "source": str,
-                                        "remark": str, "ugc": str, "ugcname": str})
-        standard_lsrs["category"]=None
+    # Define standard names for each columns, depending on whether the file
+    # includes a category column or not
+    column_names = STANDARD_COLUMNS if no_category else CATEGORY_COLUMNS
+
+    # If requested, read the file with Polars instead
+    if backend == 'polars':
+        if as_arrow:
+            raise ValueError("as_arrow can only be used with backend='pandas'")
+        return read_standard_lsrs_polars(lsr_file_path, column_names,
+                                         no_index=no_index)
+    elif backend != 'pandas':
+        raise ValueError(f"Unknown backend for reading LSRs: {backend}")
+
+    # Make sure that dates and times are represented appropriately, and that
+    # report sources, categories, WFOs, type codes, and states are represented
+    # appropriately as categorical data, by reading them as such when the
+    # DataFrame is indexed
+    if no_index:
+        column_types = STANDARD_COLUMN_TYPES
     else:
-        standard_lsrs = read_csv(lsr_file_path, delimiter=',', header=0,
-                                names=["valid", "valid2", "lat", "lon",
-                                        "mag", "wfo", "typecode", "typetext",
-                                        "city", "county", "state", "source",
-                                        "remark", "category", "ugc", "ugcname"],
-                                index_col=False,#"valid2",
-                                dtype={"valid": str, "valid2": str,
-                                        "lat": str, "lon": str,
-                                        "mag": str, "wfo": str, "typecode": str,
-                                        "typetext": str, "city": str,
-                                        "county": str, "state": str, "source": str,
-                                        "remark": str, "category": str, "ugc": str,
-                                        "ugcname": str})
+        column_types = STANDARD_INDEXED_COLUMN_TYPES
+
+    # Read the file, and only convert it to a Pandas DataFrame once it has
+    # been fully parsed
+    lsr_table = read_lsr_table(lsr_file_path, column_names, column_types)
+    if no_category and not no_index:
+        lsr_table = lsr_table.append_column(
+            'category', pa.nulls(lsr_table.num_rows, CATEGORICAL_TYPE))
+
+    # If requested, return the PyArrow Table, without converting it
+    if as_arrow:
+        if no_category and no_index:
+            lsr_table = lsr_table.append_column(
+                'category', pa.nulls(lsr_table.num_rows, pa.string()))
+        return lsr_table
+
+    standard_lsrs = lsr_table.to_pandas()
+    if no_category and no_index:
+        standard_lsrs["category"]=None
 
     if not no_index:
         standard_lsrs.set_index('valid2', inplace=True)
 
-        # Make sure that dates and times are represented appropriately
-        standard_lsrs.index = to_datetime(standard_lsrs.index)
+    # Return the loaded data in a Pandas DataFrame
+    return standard_lsrs
+
 
-        # Make sure that report sources, categories, and WFOs are represented
-        # appropriately as categorical data
-        standard_lsrs.source = standard_lsrs.source.astype('category')
-        standard_lsrs.category = standard_lsrs.category.astype('category')
-        standard_lsrs.wfo = standard_lsrs.wfo.astype('category')
+def read_standard_lsrs_polars(lsr_file_path, column_names, no_index=True):
+    ''' Read a standard CSV file containing a collection of LSRs with Polars.
 
-    # Remove all NaNs from the remarks column (empty remarks) and replace them
-    # with blank strings " "
-    standard_lsrs.remark.replace(nan," ",regex=True, inplace=True)
+    This function reads a "standard" CSV file containing LSR reports (see
+    read_standard_lsrs()) into a Polars DataFrame, naming its columns as in
+    column_names, and reading all of them as strings, with empty remarks
+    replaced with blank strings " ". If no_index is False, the report sources,
+    categories, WFOs, type codes, and states are converted to categorical
+    data, and 'valid2' to dates and times, although it is kept as a column,
+    since Polars DataFrames have no index. Polars is an optional dependency,
+    only imported when this function is called.
+    '''
+    import polars as pl
 
-    # Return the loaded data in a Pandas DataFrame
+    # Read the file, defining standard names for each columns, as strings
+    standard_lsrs = pl.read_csv(lsr_file_path, has_header=True,
+                                new_columns=list(column_names),
+                                infer_schema_length=0,
+                                null_values=[''])
+
+    # Replace all nulls in the remarks column (empty remarks) with blank
+    # strings " ", and add an empty category column if there is none
+    standard_lsrs = standard_lsrs.with_columns(pl.col('remark').fill_null(' '))
+    if "category" not in column_names:
+        standard_lsrs = standard_lsrs.with_columns(
+            pl.lit(None, dtype=pl.Utf8).alias('category'))
+
+    if not no_index:
+        # Make sure that dates and times are represented appropriately, trying
+        # ISO 8601 first, and then the formats found in the LSR archives. The
+        # formats are always given explicitly, since Polars raises an error,
+        # even if strict=False, when it cannot infer one
+        valid2 = pl.col('valid2').str
+        standard_lsrs = standard_lsrs.with_columns(pl.coalesce(
+            [valid2.to_datetime(timestamp_format, strict=False)
+             for timestamp_format in ISO8601_FORMATS + TIMESTAMP_FORMATS]
+        ).alias('valid2'))
+
+        # Make sure that report sources, categories, WFOs, type codes, and
+        # states are represented appropriately as categorical data
+        standard_lsrs = standard_lsrs.with_columns(
+            pl.col(list(STANDARD_CATEGORICAL_COLUMNS)).cast(pl.Categorical))
+
+    # Return the loaded data in a Polars DataFrame
     return standard_lsrs
 
 
+def iter_standard_lsrs(lsr_file_path, batch_size, no_category=True):
+    ''' Read a standard CSV file containing LSRs, one batch at a time.
+
+    This generator streams a "standard" CSV file containing LSR reports (see
+    read_standard_lsrs()) in blocks of CSV_BLOCK_SIZE bytes, yielding Pandas
+    DataFrames of batch_size reports each (the last one may be shorter), in
+    order, so that only a few blocks of the file are held in memory at once.
+    Each DataFrame is indexed by the position of its reports in the file, and
+    every column is read as strings, as read_standard_lsrs() does when
+    no_index is True, so no dates and times have to be parsed. Note that
+    gpt_classify.py does not use it, since it needs every report at once, to
+    rebuild the CSV file of classified LSRs from the batch result files.
+    '''
+    # Define standard names for each columns, depending on whether the file
+    # includes a category column or not
+    column_names = STANDARD_COLUMNS if no_category else CATEGORY_COLUMNS
+
+    # Options to stream the file, in blocks of CSV_BLOCK_SIZE bytes
+    read_options, parse_options, convert_options = lsr_csv_options(
+        column_names, STANDARD_COLUMN_TYPES)
+    read_options.block_size = CSV_BLOCK_SIZE
+
+    # Convert a batch of LSRs to a Pandas DataFrame, indexed by the position
+    # of its reports in the file
+    def batch_lsrs(lsr_table, start_idx):
+        standard_lsrs = fill_blank_remarks(lsr_table).to_pandas()
+        if no_category:
+            standard_lsrs["category"] = None
+        standard_lsrs.index = RangeIndex(start_idx,
+                                         start_idx + lsr_table.num_rows)
+        return standard_lsrs
+
+    # Blocks which have been read, but not yielded yet, along with
+    # their number of reports, and the index of the next report to be yielded
+    pending = []
+    pending_rows = 0
+    start_idx = 0
+
+    # Open the memory-mapped file for streaming
+    with pa.memory_map(lsr_file_path) as lsr_file:
+        reader = pv.open_csv(lsr_file,
+                             read_options=read_options,
+                             parse_options=parse_options,
+                             convert_options=convert_options)
+
+        # Read the file one block at a time, yielding every full batch of
+        # reports as soon as it is available
+        for record_batch in reader:
+            pending.append(record_batch)
+            pending_rows += record_batch.num_rows
+            while pending_rows >= batch_size > 0:
+                lsr_table = pa.Table.from_batches(pending,
+                                                  schema=reader.schema)
+                yield batch_lsrs(lsr_table.slice(0, batch_size), start_idx)
+                lsr_table = lsr_table.slice(batch_size)
+                pending = lsr_table.to_batches()
+                pending_rows = lsr_table.num_rows
+                start_idx += batch_size
+
+        # Yield the remaining reports, if any, as the last (shorter) batch
+        if pending_rows:
+            yield batch_lsrs(pa.Table.from_batches(pending,
+                                                   schema=reader.schema),
+                             start_idx)
+
+
 def read_ibw_lsrs(lsr_file_path, no_index=True):
     """ Read a CSV file containing a collection of Expertly-Classified LSRs
 
     The 'magnitude' field corresponds to IBW categories for each LSR
     """
-    # Read the file, and define standard names for each columns, as well as
-    # approrpiate data types
-    standard_lsrs = read_csv(lsr_file_path, delimiter=',', header=0,
-                             names=["time", "office", "local_time",
-                                    "county", "location", "state",
-                                    "event_type", "magnitude", "source",
-                                    "lat", "lon", "remark"],
-                             index_col=False,  # "valid2",
-                             dtype={"time": str,
-                                    "office": str,
-                                    "local_time": str,
-                                    "county": str,
-                                    "location": str,
-                                    "state": str,
-                                    "event_type": str,
-                                    "magnitude": str,
-                                    "source": str,
-                                    "lat": str,
-                                    "lon": str,
-                                    "remark": str})
-    standard_lsrs["category"] = None
+    # Make sure that report times and local times are represented
+    # appropriately, and that report sources, magnitudes, and offices are
+    # represented appropriately as categorical data, by reading them as such
+    # when the DataFrame is indexed
+    if no_index:
+        column_types = IBW_COLUMN_TYPES
+    else:
+        column_types = IBW_INDEXED_COLUMN_TYPES
 
+    # Read the file, defining standard names for each columns, and only
+    # convert it to a Pandas DataFrame once it has been fully parsed
+    lsr_table = read_lsr_table(lsr_file_path, IBW_COLUMNS, column_types)
     if not no_index:
-        standard_lsrs.set_index('time', inplace=True)
-
-        # Make sure that dates and times are represented appropriately
-        standard_lsrs.index = to_datetime(standard_lsrs.index)
-        standard_lsrs.local_time = to_datetime(standard_lsrs.local_time)
-
-        # Make sure that report sources, categories, and WFOs are represented
-        # appropriately as categorical data
-        standard_lsrs.source = standard_lsrs.source.astype('category')
-        standard_lsrs.magnitude = standard_lsrs.source.astype('magnitude')
-        standard_lsrs.category = standard_lsrs.category.astype('category')
-        standard_lsrs.office = standard_lsrs.wfo.astype('office')
+        lsr_table = lsr_table.append_column(
+            'category', pa.nulls(lsr_table.num_rows, CATEGORICAL_TYPE))
+    standard_lsrs = lsr_table.to_pandas()
+    if no_index:
+        standard_lsrs["category"] = None
 
-    # Remove all NaNs from the remarks column (empty remarks) and replace them
-    # with blank strings " "
-    standard_lsrs.remark.replace(nan, " ", regex=True, inplace=True)
+    if not no_index:
+        # Parse the local times with their own format, leaving those which
+        # do not match it to Pandas
+        standard_lsrs["local_time"] = parse_datetimes(
+            standard_lsrs["local_time"], [IBW_LOCAL_TIME_FORMAT])
+        standard_lsrs.set_index('time', inplace=True)
 
     # Return the loaded data in a Pandas DataFrame
     return standard_lsrs
@@ -158,47 +498,181 @@ def ffsi_score(probs, normalize=False):
     values across the total number of classes. This score can also be normalized
     to values between 0 and 1.
     '''
-    # If the input probabilities are passed in as a dictionary
+    # If the input probabilities are passed in as a dictionary, get them in
+    # order of severity. Else, assume they were passed as a list of numbers
     if type(probs) is dict:
-        # Calculate the score, assume probabilities are in percent
-        ffsi_score = (probs["MINOR"] / 100 * 1 +
-                      probs["MODERATE"] / 100 * 2 +
-                      probs["SERIOUS"] / 100 * 3 +
-                      probs["SEVERE"] / 100 * 4 +
-                      probs["CATASTROPHIC"] / 100 * 5)
-
-    # Else if the input probabilities are passed as a list of numbers
-    elif type(probs) is list:
-        # Calculate the score, assume probabilities are in percent
-        ffsi_score = (probs[0] / 100 * 1 +
-                      probs[1] / 100 * 2 +
-                      probs[2] / 100 * 3 +
-                      probs[3] / 100 * 4 +
-                      probs[4] / 100 * 5)
+        probs = GET_IMPACT_PROBS(probs)
+    else:
+        probs = probs[:len(IMPACT_CLASSES)]
+
+    # Calculate the score, assume probabilities are in percent
+    ffsi_score = float(dot(probs, FFSI_WEIGHTS))
 
     # If varues are to be normalized
     if normalize:
         # Divide the score by the number of classes
-        ffsi_score /= 5
+        ffsi_score /= len(IMPACT_CLASSES)
 
     # Return the calculated FFSI score
     return ffsi_score
 
 
+def ffsi_score_batch(probs_matrix, normalize=False):
+    ''' Calculate the scores of many LSRs from their FFSI class probabilities.
+
+    This function works like ffsi_score(), but receives a matrix (or list of
+    lists) of FFSI class probabilities (in percents), with one row per LSR
+    and one column per class, and returns a NumPy array with the score of
+    each LSR, calculated at once.
+    '''
+    # Calculate the scores, assume probabilities are in percent
+    ffsi_scores = asarray(probs_matrix, dtype=float) @ FFSI_WEIGHTS
+
+    # If varues are to be normalized
+    if normalize:
+        # Divide the scores by the number of classes
+        ffsi_scores /= len(IMPACT_CLASSES)
+
+    # Return the calculated FFSI scores
+    return ffsi_scores
+
+
+def merge_batch_results(lsr_batch, batch_results):
+    ''' Add the FFSI classification results of a batch to its LSRs.
+
+    This function receives the DataFrame of Local Storm Reports in a batch,
+    and the dictionary of classified LSRs produced for it (as returned by
+    classify_lsr_remarks(), or as read back from its JSON results file, whose
+    keys are the positions of the LSRs within the batch). It returns a copy
+    of the batch's LSRs, with additional columns holding the probabilities of
+    each FFSI class (as fractions), the FFSI score, and any extra GPT output.
+    '''
+    # Names of the FFSI class columns, and of all the new result columns
+    impact_classes = list(IMPACT_CLASSES)
+    result_columns = impact_classes + ["FFSI", "EXTRA"]
+
+    # Dictionary of lists which will accumulate the results of every LSR
+    results = {column: [] for column in result_columns}
+    for batch_index in batch_results:
+        for impact_class in impact_classes:
+            results[impact_class].append(
+                batch_results[batch_index][1][impact_class])
+        results["FFSI"].append(batch_results[batch_index][2])
+        results["EXTRA"].append(batch_results[batch_index][3])
+
+    # Assemble all the results, indexed like their corresponding LSRs, and
+    # convert the probabilities from percents at once
+    positions = [int(batch_index) for batch_index in batch_results]
+    results = DataFrame(results, index=lsr_batch.index[positions])
+    results[impact_classes] = results[impact_classes] / 100
+
+    # Return the LSRs of the batch along with their results
+    return lsr_batch.join(results)
+
+
+def append_results_csv(results, csv_path):
+    ''' Append a DataFrame of classified LSRs to a CSV file.
+
+    This function appends the rows of a DataFrame of classified LSRs to a CSV
+    file, writing the header row only if the file doesn't exist yet.
+    '''
+    results.to_csv(csv_path, mode="a", header=not os.path.exists(csv_path),
+                   index=False)
+
+
 def write_results_json(results, fname="./results/test.json", indent=2):
     ''' Write a JSON file containing LSR remarks, FFSI classification and score.
 
     This function writes out a dictionary of Classified LSRs into a JSON file,
     including the remarks, the probability classes, and their FFSI scores.
+    The whole dictionary is serialized in memory first, and then written to
+    the file with a single write call. Note that any non-zero indent results
+    in a 2 space indentation.
     '''
-    # Open a new file to be written
-    with open(fname, "w") as outfile:
-        # Dump the dictionary as JSON
-        json.dump(results, outfile, indent=indent)
+    # Serialize the dictionary as JSON, allowing for its integer keys
+    option = orjson.OPT_NON_STR_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    buffer = memoryview(orjson.dumps(results, option=option))
+
+    # Open a new file to be written, and write the whole buffer to it
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while buffer:
+            buffer = buffer[os.write(fd, buffer):]
+    finally:
+        os.close(fd)
+
+
+def write_json(contents, fname):
+    ''' Atomically write a dictionary as a JSON file.
+
+    This function writes out a dictionary into a temporary JSON file, and then
+    renames it to its final name, so that the file is never left half-written
+    in case of interruptions.
+    '''
+    temp_fname = fname + ".tmp"
+    write_results_json(contents, temp_fname, indent=0)
+    os.replace(temp_fname, fname)
+
+
+def write_progress(batch_ids, progress_path, csv_path):
+    ''' Atomically write the progress file of an LSR file being classified.
+
+    The progress file holds the IDs of the batches that have been processed,
+    along with the size in bytes of the CSV file of classified LSRs at that
+    point (0 if it doesn't exist), so that a CSV file which doesn't hold
+    exactly the results of those batches can be detected, and rebuilt.
+    '''
+    csv_size = os.path.getsize(csv_path) if os.path.exists(csv_path) else 0
+    write_json({"processed": batch_ids, "csv_size": csv_size}, progress_path)
+
+
+@dataclass(slots=True)
+class BatchPlan:
+    ''' Batches defined to batch process a DataFrame of LSRs.
+
+    The batches are held as three NumPy arrays, indexed by batch ID: the first
+    (starts) and last (ends) index of the reports in each batch, and whether
+    each batch has been processed successfully or not (processed). A batch is
+    marked as processed by setting its value in the processed array.
+    '''
+    starts: ndarray
+    ends: ndarray
+    processed: ndarray
+
+    def __len__(self):
+        return len(self.starts)
+
+    def pending(self):
+        ''' Return the batches that have not been processed yet.
+
+        The batches are returned as an iterator of (<batch_id>,
+        <start_index>, <end_index>) tuples, in order.
+        '''
+        batch_ids = flatnonzero(~self.processed)
+        return zip(batch_ids.tolist(),
+                   self.starts[batch_ids].tolist(),
+                   self.ends[batch_ids].tolist())
+
+    def processed_ids(self):
+        ''' Return the list of IDs of the batches that have been processed.
+        '''
+        return flatnonzero(self.processed).tolist()
+
+    def is_out_of_order(self):
+        ''' Return whether any pending batch comes before a processed one.
+
+        If so, appending the results of the pending batches as they are
+        processed would not keep them in the order of the LSRs.
+        '''
+        pending_ids = flatnonzero(~self.processed)
+        return bool(pending_ids.size and
+                    self.processed[pending_ids[0]:].any())
 
 
 def define_batches(num_reports, batch_size=100):
-    '''Define a dictionary of batches to batch process a dataframe of LSRs
+    '''Define the batches to batch process a dataframe of LSRs
 
     This function takes the total number of reports, and calculates a number of
     batches using a specific batch size. These batches are assigned an ID, and
@@ -206,133 +680,213 @@ def define_batches(num_reports, batch_size=100):
     batch of the input DataFrame's total size corresponds to at most the
     defined batch size.
 
-    Batches are defined as dictionary entries with the following structure:
-        {
-            <batch_id> : {
-                            "indices": (<start_index>, <end_index>),
-                            "processed": False
-                         }
-        }
-    where <batch_id> is an integer (starting at 0), <start_index> is the
-    first index of this batch, and <end_index> is the last index of the batch.
-    Note that the last index in the last batch will be equal to num_reports-1
-    since the indices start at 0, and not at 1! The 'processed' key will be
-    used to keep track of whether this specific batch has been processed
+    Batches are defined in a BatchPlan, holding an array with the first index
+    (starts) and one with the last index (ends) of each batch, where the
+    batch ID is an integer (starting at 0) indexing these arrays. Note that
+    the last index in the last batch will be equal to num_reports-1 since the
+    indices start at 0, and not at 1! The 'processed' array will be used to
+    keep track of whether each specific batch has been processed
     successfully or not.
     '''
-    # Output dictionary of batches based on the input DataFrame
-    batches = {}
-
     # If batch size is == 0, assume no batching is desired, and output a single
     # batch holding the entirety of the num_reports
     if batch_size == 0:
-        batches[batch_size] = {"indices": (0, num_reports - 1),
-                               "processed": False}
-    # Else if the batch size is not zero, do the appropriate calculations, and
-    # define the number of full and partial batches corresponding to the
-    # requested parameters
+        starts = zeros(1, dtype="int64")
+        ends = starts + num_reports - 1
+
+    # Else if the batch size is not zero, calculate the start of every batch
+    # at once, and end each one batch_size - 1 reports later, except for the
+    # last (partial) batch, which ends with the last report
     else:
-        # Number of "full" batches
-        full_batches = num_reports // batch_size
-
-        # Remainder for "partial" batch
-        partial_batch = num_reports % batch_size
-
-        # Add the "full" batches to the dictionary
-        for batch in range(full_batches):
-            batches[batch] = {"indices": (batch_size * batch,
-                                          batch_size * (batch + 1) - 1),
-                              "processed": False}
-
-        # If available, add the partial batch to the dictionary
-        if partial_batch > 0:
-            batches[full_batches] = {"indices": (batch_size * full_batches,
-                                                 (batch_size * full_batches)
-                                                 + partial_batch - 1),
-                                     "processed": False}
-
-    # Return the batches dictionary
-    return batches
+        starts = arange(0, num_reports, batch_size, dtype="int64")
+        ends = minimum(starts + batch_size, num_reports) - 1
+
+    # Return the batches, none of which has been processed yet
+    return BatchPlan(starts=starts, ends=ends,
+                     processed=zeros(len(starts), dtype=bool))
 
 
 def hash_filename(file_path, verbose=False):
     ''' Strip the filename from a path, and generate a 22 digit UUID from it.
 
     This function receives a complete file path, remove any route paths out of
-    it, and then generates a unique 'short' identifier (using shortuui) based
-    on the stripped filename (including the file's extension).
+    it, and then generates a unique 'short' identifier based on the stripped
+    filename (including the file's extension): its 16 byte BLAKE2b digest,
+    encoded in URL-safe base64 without padding.
     '''
     # Remove any paths from the file name
-    stripped_filename = str(file_path).split('/')[-1]
+    stripped_filename = os.path.basename(str(file_path))
 
     # If verbose, print the original path and the stripped file name
     if verbose:
         print(f"FILE_PATH: {file_path}\nFILE_NAME: {stripped_filename}")
 
     # Hash the file name and return a unique identifier
-    return uuid(stripped_filename)
+    digest = hashlib.blake2b(stripped_filename.encode(), digest_size=16)
+    return base64.urlsafe_b64encode(digest.digest()).rstrip(b"=").decode()
+
+
+def legacy_hash_filename(file_path):
+    ''' Generate the 22 digit UUID of a file name used by earlier versions.
+
+    Earlier versions of hash_filename() used shortuuid, which encodes the
+    UUID5 of the stripped file name (in the URL namespace for URLs, and in
+    the DNS one otherwise) with its 57 character alphabet. This function
+    reproduces those identifiers, so that results and progress files left by
+    earlier runs can be found.
+    '''
+    # Remove any paths from the file name, as earlier versions did
+    stripped_filename = str(file_path).split('/')[-1]
+
+    # Compute the UUID5 of the file name, as shortuuid does
+    if stripped_filename.lower().startswith(("http://", "https://")):
+        namespace = uuid.NAMESPACE_URL
+    else:
+        namespace = uuid.NAMESPACE_DNS
+    number = uuid.uuid5(namespace, stripped_filename).int
+
+    # Encode it with shortuuid's alphabet, most significant digit first,
+    # padded to 22 digits
+    digits = []
+    while number:
+        number, digit = divmod(number, len(LEGACY_UUID_ALPHABET))
+        digits.append(LEGACY_UUID_ALPHABET[digit])
+    digits += LEGACY_UUID_ALPHABET[0] * max(22 - len(digits), 0)
+    return "".join(reversed(digits))
 
 
 def get_files_in_dir(dir_path="./", extension=""):
     ''' Return a list of files with the same extension in a given directory.
     '''
-    # Output list holding the complete file paths
-    found_files = []
+    # Iterate over the entries in the directory, and return the complete paths
+    # of the files whose extension matches what we are searching for
+    with os.scandir(dir_path) as entries:
+        return [entry.path for entry in entries
+                if entry.is_file() and entry.name.endswith(extension)]
+
+
+def find_batch_results(file_uuid, results_path="./results/"):
+    ''' Find the batch result JSON files for a UUID, sorted by batch ID.
+
+    This function returns a list of (<batch_id>, <file_path>) tuples, for the
+    batch result JSON files of the specified file UUID in the results path,
+    sorted by batch ID. The expected format for the batch result files is:
+        <results_path>/<file_uuid>_<batch_id>.json
+    '''
+    # Pattern matching the batch ID at the end of the file names
+    pattern = re.compile(rf"{re.escape(file_uuid)}_(\d+)\.json$")
+
+    # Let the OS find the JSON files for the specified UUID, and keep those
+    # whose names end with a batch ID, along with it
+    result_files = []
+    file_pattern = os.path.join(glob.escape(results_path),
+                                f"{glob.escape(file_uuid)}_*.json")
+    for json_file in glob.iglob(file_pattern):
+        batch_match = pattern.match(os.path.basename(json_file))
+        if batch_match:
+            result_files.append((int(batch_match[1]), json_file))
+
+    # Return the batch result files, sorted by batch ID
+    return sorted(result_files)
+
+
+def read_batch_results(file_uuid, results_path="./results/", batch_ids=None):
+    ''' Read the batch result JSON files for a UUID in parallel.
+
+    This function finds the batch result JSON files of the specified file UUID
+    in the results path (see find_batch_results()), and reads them on a pool
+    of threads, so that waiting on the disk overlaps. If batch_ids is given,
+    only the files of those batches are read. It returns a list of
+    (<batch_id>, <batch_results>) tuples, sorted by batch ID.
+    '''
+    # Find the JSON batch result files, along with their batch IDs
+    result_files = find_batch_results(file_uuid, results_path)
+    if batch_ids is not None:
+        batch_ids = set(batch_ids)
+        result_files = [(batch_id, json_file)
+                        for batch_id, json_file in result_files
+                        if batch_id in batch_ids]
+    if not result_files:
+        return []
 
-    # Iterate over the list of files in the directory
-    for file in os.listdir(dir_path):
-        # If the file's extension matches what we are searching for
-        if file.endswith(extension):
-            # Add the file to the output file list
-            found_files.append(os.path.join(dir_path, file))
+    # Read all the results JSON files in parallel
+    max_workers = min(32, (os.cpu_count() or 1) * 4, len(result_files))
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        batch_results_list = ex.map(
+            read_json_results, [json_file for _, json_file in result_files])
 
-    # Return the list of found files
-    return found_files
+        # Return the results of each batch, along with its batch ID
+        return [(batch_id, batch_results)
+                for (batch_id, _), batch_results in zip(result_files,
+                                                        batch_results_list)]
 
 
 def match_batch_results(file_uuid, batches, results_path="./results/"):
-    '''
+    ''' Mark the batches which already have a batch result JSON file.
 
     The expected format for the batch result files is:
         <results_path>/<file_uuid>_<batch_id>.json
     '''
-
-    # Check if there are any JSON files in the specified path
-    result_files = get_files_in_dir(results_path, extension=".json")
-
-    # Make sure that the JSON files found match the specified UUID
-    result_files = list(filter(lambda x: file_uuid in x, result_files))
+    # Check if there are any JSON batch result files for the specified UUID
+    result_files = find_batch_results(file_uuid, results_path)
 
     # If the list of files in the requested folder, with the requested uuid is
-    # empty, notify that no previous batch results were found, and return a
-    # None value
+    # empty, notify that no previous batch results were found
     if not result_files:
         print("WARNING: No previous batch results found for current uuid!")
 
-    # Else if there are valid files that match the uuid
-    else:
-        # For each of these files
-        for json_file in result_files:
-            # Determine its batch ID
-            batch_id = json_file.split("/")[-1].split("_")[-1].split(".")[0]
-            # Set this batch's processed variable as True
-            batches[int(batch_id)]["processed"] = True
-
-    # Return the batches dictionary, with updated "processed" values for all
-    # the JSON batch results files found
+    # Mark the batch of each of these files as processed, ignoring files of
+    # batches which are not defined (e.g. left by a different batch size)
+    for batch_id, json_file in result_files:
+        if batch_id < len(batches):
+            batches.processed[batch_id] = True
+        else:
+            print(f"WARNING: Ignoring batch result file {json_file}, since "
+                  f"there are only {len(batches)} batches!")
+
+    # Return the batches, with updated "processed" values for all the JSON
+    # batch results files found
     return batches
 
 
+def unmark_missing_results(batches, found_ids):
+    ''' Mark the processed batches with no batch result JSON file as pending.
+
+    This function makes sure that batches which are marked as processed (e.g.
+    by a progress file), but whose batch result JSON file has been lost, are
+    processed again, warning about them. The batch result files which were
+    found are given by their batch IDs (found_ids), e.g. as returned by
+    read_batch_results(), so that the results folder is not scanned again.
+    It returns the batches, along with the number of batches that were
+    marked as pending.
+    '''
+    # Find the processed batches which have no JSON batch result file
+    found = zeros(len(batches), dtype=bool)
+    for batch_id in found_ids:
+        if batch_id < len(batches):
+            found[batch_id] = True
+    missing = batches.processed & ~found
+
+    # Mark them as pending, so that they are processed again
+    num_missing = int(missing.sum())
+    if num_missing:
+        print(f"WARNING: {num_missing} processed batches have no batch "
+              f"result file, and will be processed again!")
+        batches.processed[missing] = False
+
+    return batches, num_missing
+
+
 def read_json_results(json_file_path):
     ''' Read a JSON file containing LSR remarks, FFSI classification and score.
 
     This function reads in a JSON file of Classified LSRs into a dictionary,
     including the remarks, the probability classes, and their FFSI scores.
     '''
-    # Open the file to be read
-    with open(json_file_path, 'r') as j:
+    # Open the file to be read, as bytes, which orjson parses directly
+    with open(json_file_path, 'rb') as j:
         # Load the dictionary as JSON
-        contents = json.loads(j.read())
+        contents = orjson.loads(j.read())
 
     # Return the contents of the file
     return contents
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Make the project modules importable from the tests, wherever pytest is run
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,178 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import gpt_classify
+import gpt_common as gpt
+import impacts_common as impacts
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "data", "test_flashflood_LSRs.csv")
+
+
+class Classifier:
+    ''' Runs classify_lsr_file() on a copy of the test LSR file, in batches of
+    10 LSRs, classifying every remark with a stand-in for classify_lsr_remarks.
+
+    The remarks of every batch sent to be classified are recorded in calls.
+    '''
+    def __init__(self, tmp_path, monkeypatch):
+        self.lsr_file = str(tmp_path / "lsrs.csv")
+        self.results_path = str(tmp_path / "results")
+        shutil.copyfile(DATA_FILE, self.lsr_file)
+        os.mkdir(self.results_path)
+
+        monkeypatch.setattr(gpt_classify, "LSR_FILE", self.lsr_file)
+        monkeypatch.setattr(gpt_classify, "RESULTS_OUTPUT", self.results_path)
+        monkeypatch.setattr(gpt_classify, "BATCH_SIZE", 10)
+        monkeypatch.setattr(gpt, "classify_lsr_remarks", self.classify)
+
+        self.uuid = impacts.hash_filename(self.lsr_file)
+        self.remarks = impacts.read_lsr_remarks(self.lsr_file, "REMARK")
+        self.calls = []
+
+    def classify(self, lsr_remarks_list, impact_defs, **kwargs):
+        self.calls.append(list(lsr_remarks_list))
+        probs = dict.fromkeys(gpt.IMPACT_CLASSES, 20)
+        return {index: [remark, probs, 3.0, ""]
+                for index, remark in enumerate(lsr_remarks_list)}
+
+    def run(self, reconcile=False):
+        self.calls = []
+        writer = ThreadPoolExecutor(max_workers=1)
+        gpt_classify.classify_lsr_file(None, None, None, None, writer,
+                                       reconcile=reconcile)
+
+    def batch_remarks(self, *batch_ids):
+        return [self.remarks[batch_id * 10 : (batch_id + 1) * 10]
+                for batch_id in batch_ids]
+
+    def path(self, suffix):
+        return os.path.join(self.results_path, f"{self.uuid}{suffix}")
+
+    def classified_remarks(self):
+        return impacts.read_lsr_remarks(self.path("_classified.csv"),
+                                        "remark")
+
+
+@pytest.fixture
+def classifier(tmp_path, monkeypatch):
+    return Classifier(tmp_path, monkeypatch)
+
+
+def test_classifies_every_batch_in_order(classifier):
+    classifier.run()
+
+    assert classifier.calls == classifier.batch_remarks(0, 1, 2, 3, 4)
+    assert classifier.classified_remarks() == classifier.remarks
+
+
+def test_reprocessed_batch_keeps_the_csv_in_lsr_order(classifier):
+    classifier.run()
+
+    # Missing result files are found when the CSV file is rebuilt
+    os.remove(classifier.path("_2.json"))
+    os.remove(classifier.path("_classified.csv"))
+
+    classifier.run()
+
+    assert classifier.calls == classifier.batch_remarks(2)
+    assert classifier.classified_remarks() == classifier.remarks
+
+    # The rebuilt CSV file matches the progress file, so it is kept as is
+    classified_size = os.path.getsize(classifier.path("_classified.csv"))
+    classifier.run()
+
+    assert classifier.calls == []
+    assert (os.path.getsize(classifier.path("_classified.csv"))
+            == classified_size)
+
+
+def test_reconcile_ignores_result_files_of_undefined_batches(classifier):
+    classifier.run()
+    shutil.copyfile(classifier.path("_4.json"), classifier.path("_7.json"))
+
+    classifier.run(reconcile=True)
+
+    assert classifier.calls == []
+    assert classifier.classified_remarks() == classifier.remarks
+
+
+def test_progress_ignores_undefined_batches(classifier):
+    classifier.run()
+    impacts.write_progress([0, 1, 2, 3, 4, 7],
+                           classifier.path(".progress.json"),
+                           classifier.path("_classified.csv"))
+
+    classifier.run()
+
+    assert classifier.calls == []
+    assert classifier.classified_remarks() == classifier.remarks
+    assert (impacts.read_json_results(classifier.path(".progress.json"))
+            ["processed"] == [0, 1, 2, 3, 4])
+
+
+def test_resumes_after_an_interrupted_append(classifier, monkeypatch):
+    monkeypatch.setattr(gpt_classify, "MAX_BATCHES", 3)
+    classifier.run()
+    monkeypatch.setattr(gpt_classify, "MAX_BATCHES", 0)
+
+    # Interrupted after appending part of a batch to the CSV file, but before
+    # updating the progress file
+    with open(classifier.path("_classified.csv"), "a") as classified_file:
+        classified_file.write("partial,row\n")
+
+    classifier.run()
+
+    assert classifier.calls == classifier.batch_remarks(4)
+    assert classifier.classified_remarks() == classifier.remarks
+
+
+def test_reprocesses_the_last_batch_if_its_result_file_is_missing(classifier):
+    classifier.run()
+    os.remove(classifier.path("_4.json"))
+    os.remove(classifier.path("_classified.csv"))
+
+    classifier.run()
+
+    assert classifier.calls == classifier.batch_remarks(4)
+    assert classifier.classified_remarks() == classifier.remarks
+
+
+def test_resumes_from_result_files_without_a_progress_file(classifier):
+    classifier.run()
+    os.remove(classifier.path(".progress.json"))
+    os.remove(classifier.path("_3.json"))
+
+    classifier.run()
+
+    assert classifier.calls == classifier.batch_remarks(3)
+    assert classifier.classified_remarks() == classifier.remarks
+
+
+def test_resumes_without_scanning_the_results_folder(classifier,
+                                                     monkeypatch):
+    classifier.run()
+    os.remove(classifier.path("_4.json"))
+
+    def iglob(pattern):
+        raise AssertionError(f"Scanned {pattern}")
+
+    monkeypatch.setattr(impacts.glob, "iglob", iglob)
+    classifier.run()
+
+    # The progress file is trusted, so the missing file goes unnoticed
+    assert classifier.calls == []
+    assert classifier.classified_remarks() == classifier.remarks
+
+
+def test_reconcile_reprocesses_batches_with_missing_result_files(classifier):
+    classifier.run()
+    os.remove(classifier.path("_1.json"))
+
+    classifier.run(reconcile=True)
+
+    assert classifier.calls == classifier.batch_remarks(1)
+    assert classifier.classified_remarks() == classifier.remarks
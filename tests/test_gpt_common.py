@@ -0,0 +1,342 @@
+import asyncio
+import json
+import os
+from time import monotonic
+from types import SimpleNamespace
+
+import pytest
+
+import gpt_common as gpt
+
+
+def impact_probs(minor):
+    ''' Return a valid classification dictionary, identified by its MINOR.
+    '''
+    return {"MINOR": minor, "MODERATE": 0, "SERIOUS": 0, "SEVERE": 0,
+            "CATASTROPHIC": 100 - minor}
+
+
+class StubClient:
+    ''' Stand-in for AsyncOpenAI, answering from a function of the query.
+
+    The answer function receives the content of the last message, and returns
+    the content of the completion (or raises). Every query it receives is
+    recorded in calls.
+    '''
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = []
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, **kwargs):
+        query = messages[-1]["content"]
+        self.calls.append(query)
+        content = await self.answer(query)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(
+                message=SimpleNamespace(content=content))],
+            usage=None)
+
+
+def batch_client(batch_answer):
+    ''' Stub client answering batched queries with batch_answer, and every
+    single query with the probabilities of its remark's length.
+    '''
+    async def answer(query):
+        if query.startswith(gpt.BATCH_INSTRUCTIONS):
+            return batch_answer
+        return json.dumps(impact_probs(len(query)))
+
+    return StubClient(answer)
+
+
+def minor_probs(results):
+    return [json.loads(result)["MINOR"] for result in results]
+
+
+def test_batch_answers_are_matched_by_idx():
+    answer = json.dumps([dict(impact_probs(9), idx=2),
+                         dict(impact_probs(7), idx=1)])
+    client = batch_client(answer)
+
+    results = asyncio.run(gpt.query_gpt_batch_async(client, ["x", "yy"]))
+
+    assert minor_probs(results) == [7, 9]
+    assert len(client.calls) == 1
+
+
+def test_batch_answers_have_no_extra_output():
+    answer = "Here you go: " + json.dumps(
+        [dict(impact_probs(9), idx=1), dict(impact_probs(7), idx=2)]) + " Bye"
+    client = batch_client(answer)
+
+    results = gpt.classify_lsr_remarks(["x", "yy"], "defs", client=client,
+                                       remarks_per_request=2)
+
+    assert [extra for _, _, _, extra in results.values()] == ["", ""]
+
+
+@pytest.mark.parametrize("idx_values, expected, num_calls", [
+    ((1,), [50, 2], 2),               # missing
+    ((1, 1), [1, 2], 3),              # duplicate
+    ((0, 1), [51, 2], 2),             # out of range, below
+    ((-1, 1), [51, 2], 2),            # out of range, negative (no wraparound)
+    ((1, 3), [50, 2], 2),             # out of range, above
+    (("one", 1), [51, 2], 2),         # not a number
+])
+def test_batch_answers_with_bad_idx_fall_back_to_single_queries(
+        idx_values, expected, num_calls):
+    # Answers are numbered 50, 51... in order, and single queries are
+    # answered with the length of their remark
+    answer = json.dumps([dict(impact_probs(50 + n), idx=idx_value)
+                         for n, idx_value in enumerate(idx_values)])
+    client = batch_client(answer)
+
+    results = asyncio.run(gpt.query_gpt_batch_async(client, ["x", "yy"]))
+
+    assert minor_probs(results) == expected
+    assert len(client.calls) == num_calls
+
+
+def test_batch_answer_which_is_not_json_falls_back_to_single_queries():
+    client = batch_client("Sorry, I cannot answer that.")
+
+    results = asyncio.run(gpt.query_gpt_batch_async(client, ["x", "yy"]))
+
+    assert minor_probs(results) == [1, 2]
+    assert len(client.calls) == 3
+
+
+def test_rate_limiter_lets_requests_through_within_capacity():
+    limiter = gpt.RateLimiter(rpm_capacity=10, tpm_capacity=1000)
+
+    start = monotonic()
+    for _ in range(10):
+        asyncio.run(limiter.acquire(est_tokens=100))
+
+    assert monotonic() - start < 0.1
+
+
+def test_rate_limiter_waits_for_requests():
+    # 120 RPM refill one request every 0.5 seconds
+    limiter = gpt.RateLimiter(rpm_capacity=120, tpm_capacity=10**6)
+    limiter.available_requests = 0
+
+    start = monotonic()
+    asyncio.run(limiter.acquire())
+
+    assert 0.4 < monotonic() - start < 1.0
+
+
+def test_rate_limiter_waits_for_tokens():
+    # 6000 TPM refill 50 tokens every 0.5 seconds
+    limiter = gpt.RateLimiter(rpm_capacity=1000, tpm_capacity=6000)
+    limiter.available_tokens = 0
+
+    start = monotonic()
+    asyncio.run(limiter.acquire(est_tokens=50))
+
+    assert 0.4 < monotonic() - start < 1.0
+
+
+def rate_limit_error(retry_after=None):
+    ''' Return a RateLimitError, with a Retry-After header if given.
+
+    The error is created without calling its constructor, so that its
+    response only needs the headers read by with_backoff().
+    '''
+    headers = {} if retry_after is None else {"retry-after": retry_after}
+    error = gpt.RateLimitError.__new__(gpt.RateLimitError)
+    error.response = SimpleNamespace(headers=headers)
+    return error
+
+
+def failing(*errors):
+    ''' Return a function raising each of errors in turn, then returning
+    "done", along with the list of the arguments of every call.
+    '''
+    calls = []
+
+    def fn(*args, **kwargs):
+        calls.append((args, kwargs))
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "done"
+
+    return fn, calls
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    ''' Record the delays with_backoff() sleeps for, without jitter.
+    '''
+    delays = []
+    monkeypatch.setattr(gpt, "sleep", delays.append)
+    monkeypatch.setattr(gpt.random, "uniform", lambda a, b: 0)
+    return delays
+
+
+def test_backoff_honors_retry_after(sleeps):
+    fn, calls = failing(rate_limit_error("7"), rate_limit_error("0.5"))
+
+    assert gpt.with_backoff(fn, "a", key="b") == "done"
+
+    assert sleeps == [7.0, 0.5]
+    assert calls == [(("a",), {"key": "b"})] * 3
+
+
+@pytest.mark.parametrize("retry_after", [None, "soon"])
+def test_backoff_delays_grow_exponentially_without_retry_after(
+        sleeps, retry_after):
+    fn, _ = failing(*[rate_limit_error(retry_after) for _ in range(4)])
+
+    assert gpt.with_backoff(fn, base=1.0, cap=6.0) == "done"
+
+    assert sleeps == [1.0, 2.0, 4.0, 6.0]
+
+
+def test_backoff_retries_connection_errors(sleeps):
+    fn, _ = failing(OSError("reset"), OSError("reset"))
+
+    assert gpt.with_backoff(fn, base=0.5) == "done"
+
+    assert sleeps == [0.5, 1.0]
+
+
+def test_backoff_raises_after_max_attempts(sleeps):
+    errors = [rate_limit_error() for _ in range(3)]
+    fn, calls = failing(*errors)
+
+    with pytest.raises(gpt.RateLimitError) as raised:
+        gpt.with_backoff(fn, max_attempts=3)
+
+    assert raised.value is errors[-1]
+    assert len(calls) == 3
+    assert len(sleeps) == 2
+
+
+def test_backoff_does_not_retry_other_errors(sleeps):
+    fn, calls = failing(ValueError("bad request"))
+
+    with pytest.raises(ValueError):
+        gpt.with_backoff(fn)
+
+    assert len(calls) == 1
+    assert sleeps == []
+
+
+def test_cache_answers_repeated_queries(tmp_path):
+    cache = gpt.ResponseCache(str(tmp_path / "cache.db"))
+    client = batch_client("")
+    try:
+        first = asyncio.run(gpt.query_gpt_async(client, "abc", cache=cache))
+        second = asyncio.run(gpt.query_gpt_async(client, "abc", cache=cache))
+        other = asyncio.run(gpt.query_gpt_async(client, "de", cache=cache))
+    finally:
+        cache.close()
+
+    assert first == second
+    assert minor_probs([first, other]) == [3, 2]
+    assert client.calls == ["abc", "de"]
+
+
+def test_cache_skips_cached_remarks_in_batches(tmp_path):
+    cache = gpt.ResponseCache(str(tmp_path / "cache.db"))
+    client = batch_client(json.dumps([dict(impact_probs(8), idx=1),
+                                      dict(impact_probs(9), idx=2)]))
+    try:
+        asyncio.run(gpt.query_gpt_async(client, "x", cache=cache))
+        results = asyncio.run(gpt.query_gpt_batch_async(
+            client, ["x", "yy", "zzz"], cache=cache))
+    finally:
+        cache.close()
+
+    # Only the uncached remarks are sent, numbered from 1
+    assert minor_probs(results) == [1, 8, 9]
+    assert len(client.calls) == 2
+    assert client.calls[1].endswith("\n1. yy\n2. zzz")
+
+
+def test_cache_does_not_store_results_which_cannot_be_classified(tmp_path):
+    cache = gpt.ResponseCache(str(tmp_path / "cache.db"))
+
+    async def answer(query):
+        return '{"MINOR": "lots"}'
+
+    client = StubClient(answer)
+    try:
+        asyncio.run(gpt.query_gpt_async(client, "abc", cache=cache))
+        asyncio.run(gpt.query_gpt_async(client, "abc", cache=cache))
+    finally:
+        cache.close()
+
+    assert len(client.calls) == 2
+
+
+@pytest.mark.parametrize("answer", [
+    "I'm sorry, I can't classify that.",
+    '{"MINOR": 10, "MODERATE": 90',
+])
+def test_cache_does_not_store_results_without_a_json_dictionary(
+        tmp_path, answer):
+    cache = gpt.ResponseCache(str(tmp_path / "cache.db"))
+
+    async def reply(query):
+        return answer
+
+    client = StubClient(reply)
+    try:
+        asyncio.run(gpt.query_gpt_async(client, "abc", cache=cache))
+        asyncio.run(gpt.query_gpt_async(client, "abc", cache=cache))
+    finally:
+        cache.close()
+
+    assert len(client.calls) == 2
+
+
+def test_cache_defaults_to_the_cache_file_of_gpt_classify(tmp_path,
+                                                          monkeypatch):
+    import gpt_classify
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "results").mkdir()
+    gpt.ResponseCache().close()
+
+    assert os.path.exists(gpt_classify.CACHE_FILE)
+
+def test_results_which_cannot_be_classified_are_scored_as_empty():
+    async def answer(query):
+        return 'Here: {"MINOR": 10, "MODERATE": 90}'
+
+    results = gpt.classify_lsr_remarks(["abc"], "defs",
+                                       client=StubClient(answer))
+
+    remark, probs_dict, score, extra = results[0]
+    assert probs_dict == dict.fromkeys(gpt.IMPACT_CLASSES, 0)
+    assert extra == 'Here: {"MINOR": 10, "MODERATE": 90}'
+
+
+def test_failing_group_cancels_the_groups_in_flight():
+    finished = []
+    cancelled = []
+
+    async def answer(query):
+        if query == "fail":
+            raise OSError("boom")
+        try:
+            await asyncio.sleep(0.5)
+        except asyncio.CancelledError:
+            cancelled.append(query)
+            raise
+        finished.append(query)
+        return json.dumps(impact_probs(1))
+
+    start = monotonic()
+    with pytest.raises(OSError):
+        gpt.classify_lsr_remarks(["a", "fail", "b"], "defs",
+                                 client=StubClient(answer))
+
+    assert monotonic() - start < 0.4
+    assert finished == []
+    assert sorted(cancelled) == ["a", "b"]
@@ -0,0 +1,123 @@
+import csv
+import os
+
+import pandas as pd
+import pytest
+
+import impacts_common as impacts
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "data", "test_flashflood_LSRs.csv")
+
+
+def test_iter_standard_lsrs_yields_batches_indexed_by_position(monkeypatch):
+    # Small blocks, so that batches span several of them
+    monkeypatch.setattr(impacts, "CSV_BLOCK_SIZE", 1 << 10)
+    standard_lsrs = impacts.read_standard_lsrs(DATA_FILE, no_category=False)
+
+    batches = list(impacts.iter_standard_lsrs(DATA_FILE, 10,
+                                              no_category=False))
+
+    assert [(batch.index[0], batch.index[-1]) for batch in batches] == [
+        (0, 9), (10, 19), (20, 29), (30, 39), (40, 44)]
+    for batch in batches:
+        assert (batch["remark"].tolist()
+                == standard_lsrs["remark"][batch.index].tolist())
+
+
+def test_iter_standard_lsrs_adds_an_empty_category_column(tmp_path):
+    # Copy the test LSR file without its category column
+    lsr_file = tmp_path / "lsrs.csv"
+    with open(DATA_FILE, newline="") as src, \
+            open(lsr_file, "w", newline="") as dst:
+        rows = list(csv.reader(src))
+        category = rows[0].index("CATEGORY")
+        csv.writer(dst).writerows(row[:category] + row[category + 1:]
+                                  for row in rows)
+
+    batches = list(impacts.iter_standard_lsrs(str(lsr_file), 50))
+
+    assert len(batches) == 1
+    assert batches[0].shape[0] == 45
+    assert batches[0]["category"].isna().all()
+
+
+def test_read_lsr_table_reads_unparseable_dates_as_nulls(tmp_path):
+    # Copy the test LSR file, with a date and time which can't be parsed
+    lsr_file = tmp_path / "lsrs.csv"
+    with open(DATA_FILE, newline="") as src, \
+            open(lsr_file, "w", newline="") as dst:
+        rows = list(csv.reader(src))
+        rows[3][rows[0].index("VALID2")] = "not a date"
+        csv.writer(dst).writerows(rows)
+
+    standard_lsrs = impacts.read_standard_lsrs(str(lsr_file), no_index=False,
+                                               no_category=False)
+
+    assert standard_lsrs.index.isna().tolist() == [i == 2 for i in range(45)]
+    assert standard_lsrs.index[0] == pd.Timestamp("2022-07-28 01:26")
+
+
+def test_parse_datetimes_tries_every_format_in_order():
+    values = ["2022-07-28T01:26:00", "2022/07/28 01:26", "7/28/22 1:26",
+              None, "not a date"]
+
+    datetimes = impacts.parse_datetimes(
+        values, impacts.ISO8601_FORMATS + impacts.TIMESTAMP_FORMATS,
+        errors="coerce")
+
+    assert datetimes[:3].tolist() == [pd.Timestamp("2022-07-28 01:26")] * 3
+    assert datetimes[3:].isna().all()
+
+
+def test_legacy_hash_filename_matches_shortuuid():
+    shortuuid = pytest.importorskip("shortuuid")
+
+    for file_name in ("test_flashflood_LSRs.csv", "lsrs.csv", "a"):
+        assert (impacts.legacy_hash_filename(file_name)
+                == shortuuid.uuid(file_name))
+    assert (impacts.legacy_hash_filename("./data/lsrs.csv")
+            == shortuuid.uuid("lsrs.csv"))
+
+
+def test_legacy_hash_filename_of_the_test_lsr_file():
+    assert (impacts.legacy_hash_filename(DATA_FILE)
+            == "2w8MRCGsVyBWhTjh9mtfcz")
+
+
+def test_find_batch_results_only_matches_batch_result_files(tmp_path):
+    for file_name in ("abc_10.json", "abc_2.json", "abc_x_3.json",
+                      "abc_4_1.json", "abc_5.json.tmp", "abc_classified.csv",
+                      "abc.progress.json", "abcd_6.json"):
+        (tmp_path / file_name).write_text("{}")
+
+    result_files = impacts.find_batch_results("abc", str(tmp_path))
+
+    assert result_files == [(2, str(tmp_path / "abc_2.json")),
+                            (10, str(tmp_path / "abc_10.json"))]
+
+
+def test_unmark_missing_results():
+    batches = impacts.define_batches(45, 10)
+    batches.processed[[0, 1, 2, 3]] = True
+
+    batches, num_missing = impacts.unmark_missing_results(batches,
+                                                          [0, 1, 3, 9])
+
+    assert num_missing == 1
+    assert batches.processed_ids() == [0, 1, 3]
+    assert batches.is_out_of_order()
+
+
+def test_write_progress_records_the_csv_size(tmp_path):
+    progress_path = str(tmp_path / "abc.progress.json")
+    csv_path = str(tmp_path / "abc_classified.csv")
+
+    impacts.write_progress([0, 1], progress_path, csv_path)
+    assert impacts.read_json_results(progress_path) == {
+        "processed": [0, 1], "csv_size": 0}
+
+    (tmp_path / "abc_classified.csv").write_text("a,b\n1,2\n")
+    impacts.write_progress([0, 1, 2], progress_path, csv_path)
+    assert impacts.read_json_results(progress_path) == {
+        "processed": [0, 1, 2], "csv_size": 8}